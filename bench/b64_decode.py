@@ -0,0 +1,59 @@
+# bench/b64_decode.py
+# ============================================================
+# 📏 b64_json → 画像バイト列の 1 リクエストあたりピークメモリを比べる
+# ------------------------------------------------------------
+# - before: base64.b64decode → PIL デコード → RGBA 変換 → PNG 再エンコード（以前の経路）
+# - after : binascii で 1 回だけ復号 → シグネチャ／IHDR 検証のみ（現在の経路）
+# tracemalloc は Python のヒープ（bytes など）だけを数える。PIL の画素バッファは
+# 含まれないので、before の実際のピークはここに出る値よりさらに大きい。
+#
+# 実行（アプリのルートで）:
+#   python -m bench.b64_decode
+# ============================================================
+from __future__ import annotations
+import argparse
+import base64
+import gc
+import time
+import tracemalloc
+from io import BytesIO
+from typing import Callable, List
+
+from PIL import Image
+
+from bench.png_fastpath import sample_png
+from lib.image_utils import b64decode_image, ensure_png_bytes, pil_to_png_bytes
+
+def before(b64: str) -> bytes:
+    img = Image.open(BytesIO(base64.b64decode(b64))).convert("RGBA")
+    return pil_to_png_bytes(img)
+
+def after(b64: str) -> bytes:
+    return ensure_png_bytes(b64decode_image(b64))
+
+def _peak(fn: Callable[[str], bytes], b64: str) -> tuple[float, float]:
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    out = fn(b64)
+    elapsed = time.perf_counter() - t0
+    _cur, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del out
+    return peak / 1e6, elapsed * 1000.0
+
+def main(argv: List[str] | None = None) -> None:
+    ap = argparse.ArgumentParser(description="Peak Python-heap memory of the b64_json decode paths")
+    ap.add_argument("--sizes", default="1024x1024,1536x1024")
+    args = ap.parse_args(argv)
+
+    print(f"{'size':>10} {'b64 MB':>7} {'before MB':>10} {'after MB':>9} {'before ms':>10} {'after ms':>9}")
+    for size in args.sizes.split(","):
+        w, h = (int(v) for v in size.split("x"))
+        b64 = base64.b64encode(sample_png(w, h)).decode("ascii")
+        b_mb, b_ms = _peak(before, b64)
+        a_mb, a_ms = _peak(after, b64)
+        print(f"{size:>10} {len(b64) / 1e6:>7.2f} {b_mb:>10.2f} {a_mb:>9.2f} {b_ms:>10.1f} {a_ms:>9.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# bench/png_fastpath.py
+# ============================================================
+# ⏱ API 応答（b64_json）→ 保存用 PNG の 2 経路を比べる
+# ------------------------------------------------------------
+# - 従来: base64 デコード → PIL デコード → RGBA 変換 → PNG 再エンコード
+# - 高速: base64 デコード → シグネチャ／IHDR 検証のみ（バイト列をそのまま使う）
+#
+# 実行（アプリのルートで）:
+#   python -m bench.png_fastpath --repeat 10
+# ============================================================
+from __future__ import annotations
+import argparse
+import base64
+import statistics
+import time
+from io import BytesIO
+from typing import Callable, List
+
+from PIL import Image, ImageFilter
+
+from lib.image_utils import ensure_png_bytes, pil_to_png_bytes
+
+def sample_png(width: int, height: int) -> bytes:
+    """写真に近い（圧縮の効きにくい）RGB PNG を作る。API の出力と同じく 1 枚の PNG。"""
+    bands = [
+        Image.effect_noise((width, height), 48).filter(ImageFilter.GaussianBlur(1.5))
+        for _ in range(3)
+    ]
+    noise = Image.merge("RGB", bands)
+    gradient = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    return pil_to_png_bytes(Image.blend(noise, gradient, 0.4))
+
+def transcode_path(b64: str) -> bytes:
+    img = Image.open(BytesIO(base64.b64decode(b64))).convert("RGBA")
+    return pil_to_png_bytes(img)
+
+def fast_path(b64: str) -> bytes:
+    return ensure_png_bytes(base64.b64decode(b64))
+
+def _timed(fn: Callable[[str], bytes], b64: str, repeat: int) -> List[float]:
+    fn(b64)  # ウォームアップ
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(b64)
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    return samples
+
+def main(argv: List[str] | None = None) -> None:
+    ap = argparse.ArgumentParser(description="Compare PNG transcode vs. zero-transcode fast path")
+    ap.add_argument("--sizes", default="1024x1024,1024x1536,1536x1024")
+    ap.add_argument("--repeat", type=int, default=10)
+    args = ap.parse_args(argv)
+
+    print(f"{'size':>10} {'png KB':>8} {'transcode ms':>13} {'fast ms':>9} {'speedup':>8} {'out KB (transcode)':>19}")
+    for size in args.sizes.split(","):
+        w, h = (int(v) for v in size.split("x"))
+        png = sample_png(w, h)
+        b64 = base64.b64encode(png).decode("ascii")
+        slow = statistics.median(_timed(transcode_path, b64, args.repeat))
+        fast = statistics.median(_timed(fast_path, b64, args.repeat))
+        assert fast_path(b64) == png  # 高速経路は API のバイト列そのもの
+        print(f"{size:>10} {len(png) / 1024:>8.0f} {slow:>13.1f} {fast:>9.2f} {slow / fast:>7.0f}x "
+              f"{len(transcode_path(b64)) / 1024:>19.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# bench/upload_modes.py
+# ============================================================
+# ✅ normalize_upload が RGB / RGBA 以外のモードの大きな画像も読み込めるか確かめる
+# ------------------------------------------------------------
+# - パレット（P）・透過パレット・16 ビットグレー（I;16）・1 ビット（1）
+# - どれも長辺 max_side の 4 倍にして、reduce() を通る経路を確認する
+# - 1 件ずつ新しい Python の子プロセスで実行し、ピーク RSS（VmHWM、Linux のみ）を測る。デコードだけの子の
+#   ピークとの差が「原寸のデコード以外に使ったメモリ」（原寸の RGB 版を作るとここが膨らむ）
+#
+# 実行（アプリのルートで）:
+#   python -m bench.upload_modes
+# ============================================================
+from __future__ import annotations
+import subprocess
+import sys
+import tempfile
+from io import BytesIO
+
+from PIL import Image
+
+from lib.image_ops import normalize_upload
+
+MAX_SIDE = 1536
+
+def _png(img: Image.Image, **params) -> bytes:
+    buf = BytesIO()
+    img.save(buf, format="PNG", **params)
+    return buf.getvalue()
+
+def samples() -> dict:
+    w, h = MAX_SIDE * 4 + 128, MAX_SIDE * 4
+    gradient = Image.linear_gradient("L").resize((w, h))
+    pal = gradient.convert("RGB").quantize(64)
+    return {
+        "P": (_png(pal), "RGB"),
+        "P+transparency": (_png(pal, transparency=0), "RGBA"),
+        "I;16": (_png(gradient.convert("I").point(lambda v: v * 256).convert("I;16")), "RGB"),
+        "1": (_png(gradient.convert("1")), "RGB"),
+    }
+
+_CHILD = """
+import sys
+from io import BytesIO
+from PIL import Image
+from lib.image_ops import normalize_upload
+data = open(sys.argv[1], "rb").read()
+if sys.argv[2] == "decode":
+    Image.open(BytesIO(data)).load()
+else:
+    normalize_upload(data, int(sys.argv[2]))
+for line in open("/proc/self/status"):
+    if line.startswith("VmHWM:"):
+        print(int(line.split()[1]))
+"""
+
+def _peak_rss_mb(data: bytes, what: str) -> float:
+    """新しい Python で data をデコードだけ（what="decode"）か normalize_upload し、そのピーク RSS（MB）を返す。
+
+    ru_maxrss は fork 元の分を引き継ぐので、子自身の VmHWM（Linux の /proc）を読む。
+    """
+    with tempfile.NamedTemporaryFile(suffix=".png") as f:
+        f.write(data)
+        f.flush()
+        out = subprocess.run([sys.executable, "-c", _CHILD, f.name, what],
+                             check=True, capture_output=True, text=True).stdout
+    return int(out) / 1024
+
+def main() -> None:
+    print(f"{'mode':15s} {'src':5s} {'size':>12}    {'out':>16} {'decode MB':>10} {'peak MB':>8} {'extra MB':>9}")
+    for name, (data, want_mode) in samples().items():
+        src = Image.open(BytesIO(data))
+        out = Image.open(BytesIO(normalize_upload(data, MAX_SIDE)))
+        assert max(out.size) <= MAX_SIDE, (name, out.size)
+        assert out.mode == want_mode, (name, out.mode)
+        decode = _peak_rss_mb(data, "decode")
+        peak = _peak_rss_mb(data, str(MAX_SIDE))
+        print(f"{name:15s} {src.mode:5s} {str(src.size):>12} -> {out.mode:4s} {str(out.size):>11}"
+              f" {decode:>10.0f} {peak:>8.0f} {peak - decode:>9.0f}  OK")
+
+if __name__ == "__main__":
+    main()
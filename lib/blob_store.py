@@ -0,0 +1,162 @@
+# lib/blob_store.py
+# セッションの画像を内容アドレスのファイルに置き、session_state には小さなハンドル（BlobRef）だけを持たせる。
+# BlobRef が参照数を持ち、セッション終了などでハンドルが捨てられると参照が減る。
+# 参照が 0 のまま猶予時間を過ぎたファイルは gc() で消す。
+# 参照数はプロセス内にしか無いので、ファイルはプロセスごとの data/blobs/p<pid>/ に置き、
+# gc() は自分の分だけを消す（DATA_DIR を共有する別プロセスの参照中のファイルを消さない）。
+# 終了したプロセスの分は、次に起動したプロセスがまとめて消す。
+from __future__ import annotations
+import hashlib
+import os
+import shutil
+import threading
+import time
+import weakref
+from pathlib import Path
+from typing import Dict, Optional
+
+from lib.image_utils import IMAGE_FORMATS, sniff_format
+from lib.settings import data_dir, get_section
+
+# secrets.toml の [blob_store] で上書き可
+BLOB_STORE_DEFAULTS = {
+    "grace_seconds": 3600.0,     # 参照 0 になってから消すまでの猶予
+    "gc_interval": 300.0,        # put のついでに gc() を走らせる間隔
+}
+
+class BlobRef:
+    """session_state に置くハンドル。生きている間は blob を参照中として数える。"""
+    __slots__ = ("key", "size", "fmt", "__weakref__")
+
+    def __init__(self, store: "BlobStore", key: str, size: int, fmt: str) -> None:
+        self.key = key
+        self.size = size
+        self.fmt = fmt  # png / webp / jpeg（不明なら空）
+        store._incref(key)
+        weakref.finalize(self, store._decref, key)
+
+    @property
+    def ext(self) -> str:
+        return IMAGE_FORMATS.get(self.fmt, IMAGE_FORMATS["png"])[1]
+
+    @property
+    def mime(self) -> str:
+        return IMAGE_FORMATS.get(self.fmt, IMAGE_FORMATS["png"])[0]
+
+    def read(self) -> bytes:
+        return get_blob_store().get(self.key)
+
+    def __repr__(self) -> str:
+        return f"BlobRef({self.key[:12]}…, {self.size:,} bytes)"
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:  # 権限なし＝別ユーザーのプロセスが動いている
+        return True
+    return True
+
+def _remove_stale_roots(base: Path) -> None:
+    """終了したプロセスの p<pid>/ を消す（ギャラリーはハードリンク／コピーを持つので影響しない）。"""
+    for path in base.iterdir():
+        if path.name.startswith("p") and path.name[1:].isdigit():
+            pid = int(path.name[1:])
+            if pid != os.getpid() and not _alive(pid):
+                shutil.rmtree(path, ignore_errors=True)
+        elif path.is_dir() and len(path.name) == 2:  # プロセス別にする前の data/blobs/<k[:2]>/ は誰も参照しない
+            shutil.rmtree(path, ignore_errors=True)
+
+class BlobStore:
+    def __init__(self, root: Path, grace_seconds: float, gc_interval: float) -> None:
+        self.root = root  # このプロセス専用（data/blobs/p<pid>/）
+        self.grace_seconds = grace_seconds
+        self.gc_interval = gc_interval
+        self._lock = threading.Lock()
+        self._refs: Dict[str, int] = {}
+        self._released: Dict[str, float] = {}  # key -> 参照が 0 になった時刻
+        self._last_gc = 0.0
+
+    def path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def _incref(self, key: str) -> None:
+        with self._lock:
+            self._refs[key] = self._refs.get(key, 0) + 1
+            self._released.pop(key, None)
+
+    def _decref(self, key: str) -> None:
+        with self._lock:
+            n = self._refs.get(key, 0) - 1
+            if n > 0:
+                self._refs[key] = n
+                return
+            self._refs.pop(key, None)
+            self._released[key] = time.time()
+
+    def put(self, data: bytes) -> BlobRef:
+        key = hashlib.sha256(data).hexdigest()
+        ref = BlobRef(self, key, len(data), sniff_format(data))  # 先に参照を取り、gc() に消されないようにする
+        path = self.path(key)
+        if path.exists():  # 同じ内容は 1 つのファイルを共有する
+            os.utime(path)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+            tmp.write_bytes(data)
+            tmp.replace(path)
+        if time.time() - self._last_gc > self.gc_interval:
+            self.gc()
+        return ref
+
+    def get(self, key: str) -> bytes:
+        return self.path(key).read_bytes()
+
+    def gc(self) -> int:
+        """参照 0 で猶予を過ぎたファイルを消し、消した数を返す（このプロセスの root 配下だけ）。"""
+        now = time.time()
+        self._last_gc = now
+        removed = 0
+        for path in self.root.glob("*/*"):
+            if path.suffix == ".tmp":
+                continue
+            key = path.name
+            with self._lock:  # 判定と削除の間に put() が参照を取らないように
+                if key in self._refs:
+                    continue
+                try:
+                    last = self._released.get(key) or path.stat().st_mtime
+                    if now - last < self.grace_seconds:
+                        continue
+                    path.unlink()
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+                self._released.pop(key, None)
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"referenced": len(self._refs), "refs": sum(self._refs.values()),
+                    "released": len(self._released)}
+
+_store: Optional[BlobStore] = None
+_store_lock = threading.Lock()
+
+def get_blob_store() -> BlobStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            cfg = get_section("blob_store", BLOB_STORE_DEFAULTS)
+            base = data_dir("blobs")
+            _remove_stale_roots(base)
+            _store = BlobStore(base / f"p{os.getpid()}", cfg["grace_seconds"], cfg["gc_interval"])
+        return _store
+
+def put_blob(data: bytes) -> BlobRef:
+    return get_blob_store().put(data)
+
+def read_blob(ref: Optional[BlobRef]) -> bytes:
+    """ハンドルの中身（None なら空の bytes）。"""
+    return ref.read() if ref is not None else b""
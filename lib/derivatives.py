@@ -0,0 +1,217 @@
+# lib/derivatives.py
+# 表示用の派生画像（サムネイル／プレビュー）とダウンロード用の再エンコード結果を
+# 内容ハッシュをキーにキャッシュする。ページには縮小した WebP/JPEG を出し、
+# 原寸や別形式はダウンロードボタンが押されたときだけ作る。
+# どちらのキャッシュも lib/memory_budget.py の全体上限に数え、超えたら古いものからディスクへ退避する。
+from __future__ import annotations
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple, Union
+
+from PIL import features
+
+from lib import image_ops
+from lib.blob_store import BlobRef
+from lib.image_workers import run_image_op
+from lib.memory_budget import discard_spill, get_memory_budget, read_spill, write_spill
+from lib.settings import get_section
+
+# secrets.toml の [derivatives] で上書き可
+DERIVATIVE_DEFAULTS = {
+    "thumb_px": 256,             # サムネイルの長辺
+    "preview_px": 1024,          # 画面表示用プレビューの長辺
+    "preview_format": "webp",    # webp / jpeg（jpeg は透過を白で埋める）
+    "preview_quality": 80,
+    "max_entries": 64,           # プロセス内に保持する画像数（LRU）
+    "spill_max_entries": 4096,   # メモリ上限で退避した派生画像をディスクに残しておく数
+    "encode_max_bytes": 256_000_000,  # ダウンロード用エンコード結果の保持上限（LRU）
+}
+
+# ダウンロード用の形式 → (PIL の形式名, MIME, 拡張子, 品質を使うか)
+DOWNLOAD_FORMATS = {
+    "png": ("PNG", "image/png", "png", False),    # optimize=True で最小化した PNG
+    "webp": ("WEBP", "image/webp", "webp", True),
+    "jpeg": ("JPEG", "image/jpeg", "jpg", True),
+    "avif": ("AVIF", "image/avif", "avif", True),  # Pillow が AVIF 対応でビルドされているときだけ
+}
+
+_MIME = {"webp": "image/webp", "jpeg": "image/jpeg"}
+
+@dataclass(frozen=True)
+class Derivatives:
+    key: str          # 原寸画像の sha256（原寸そのものは lib/blob_store.py に置く）
+    thumb: bytes
+    preview: bytes
+    mime: str         # thumb / preview の MIME
+    width: int        # 原寸の幅・高さ
+    height: int
+
+def _pack(d: Derivatives) -> bytes:
+    head = f"{d.mime}\n{d.width}\n{d.height}\n{len(d.thumb)}\n".encode("ascii")
+    return head + d.thumb + d.preview
+
+def _unpack(key: str, raw: bytes) -> Derivatives:
+    mime, width, height, thumb_len, body = raw.split(b"\n", 4)
+    n = int(thumb_len)
+    return Derivatives(key=key, thumb=body[:n], preview=body[n:], mime=mime.decode("ascii"),
+                       width=int(width), height=int(height))
+
+def build_derivatives(data: bytes, key: Optional[str] = None) -> Derivatives:
+    """縮小・エンコードはプロセスプールで行う（lib/image_workers.py）。"""
+    cfg = get_section("derivatives", DERIVATIVE_DEFAULTS)
+    fmt = cfg["preview_format"] if cfg["preview_format"] in _MIME else "webp"
+    (thumb, preview), size = run_image_op(image_ops.previews, data,
+                                          (cfg["thumb_px"], cfg["preview_px"]), fmt, cfg["preview_quality"])
+    return Derivatives(
+        key=key or hashlib.sha256(data).hexdigest(),
+        thumb=thumb,
+        preview=preview,
+        mime=_MIME[fmt],
+        width=size["width"],
+        height=size["height"],
+    )
+
+class DerivativeCache:
+    OWNER = "derivatives"  # lib/memory_budget.py での名前
+
+    def __init__(self, max_entries: int, spill_max_entries: int = 4096) -> None:
+        self.max_entries = max_entries
+        self.spill_max_entries = spill_max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Derivatives]" = OrderedDict()
+        self._spilled: "OrderedDict[str, None]" = OrderedDict()  # ディスクへ退避中の key（古い順）
+        self._budget = get_memory_budget()
+        self._budget.register(self.OWNER, self._spill)
+
+    def get(self, key: str, load: Callable[[], bytes]) -> Derivatives:
+        """key（内容の sha256）で引く。退避済みならディスクから読み戻し、無いときだけ load() で原寸を読んで作る。"""
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is not None:
+                self._entries.move_to_end(key)
+                self._budget.touch(self.OWNER, key)
+                return hit
+            spilled = key in self._spilled
+            self._spilled.pop(key, None)
+        raw = read_spill(self.OWNER, key) if spilled else None
+        built = _unpack(key, raw) if raw is not None else build_derivatives(load(), key)  # ロックの外で
+        dropped = []
+        with self._lock:
+            self._entries[key] = built
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                dropped.append(self._entries.popitem(last=False)[0])
+        for old in dropped:
+            self._budget.release(self.OWNER, old)
+        self._budget.charge(self.OWNER, key, len(built.thumb) + len(built.preview))
+        return built
+
+    def _spill(self, key: str) -> None:
+        """メモリ上限で追い出されたとき（lib/memory_budget.py から呼ばれる）。"""
+        with self._lock:
+            d = self._entries.pop(key, None)
+            if d is None:
+                return
+            self._spilled[key] = None
+            expired = []
+            while len(self._spilled) > self.spill_max_entries:
+                expired.append(self._spilled.popitem(last=False)[0])
+        write_spill(self.OWNER, key, _pack(d))
+        for old in expired:
+            discard_spill(self.OWNER, old)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "spilled": len(self._spilled),
+                    "bytes": sum(len(d.thumb) + len(d.preview) for d in self._entries.values())}
+
+_cache: Optional[DerivativeCache] = None
+_cache_lock = threading.Lock()
+
+def get_derivatives(image: Union[bytes, BlobRef]) -> Derivatives:
+    """原寸画像（bytes か BlobRef）の派生画像を返す（同じ内容なら 2 回目以降は再計算しない）。
+
+    BlobRef ならキーが分かっているので、命中時は原寸を読みもハッシュもしない。
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            cfg = get_section("derivatives", DERIVATIVE_DEFAULTS)
+            _cache = DerivativeCache(cfg["max_entries"], cfg["spill_max_entries"])
+    if isinstance(image, BlobRef):
+        return _cache.get(image.key, image.read)
+    return _cache.get(hashlib.sha256(image).hexdigest(), lambda: image)
+
+# ---------------- ダウンロード用の再エンコード ----------------
+def available_download_formats() -> Tuple[str, ...]:
+    return tuple(f for f in DOWNLOAD_FORMATS if f != "avif" or features.check("avif"))
+
+class EncodeCache:
+    """(内容ハッシュ, 形式, 品質) → エンコード済みバイト列。合計バイト数で上限をかける。
+
+    全体のメモリ上限で追い出されたものはディスクへ退避し、次に押されたときに読み戻す。
+    """
+    OWNER = "encodes"  # lib/memory_budget.py での名前
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str, int], bytes]" = OrderedDict()
+        self._spilled: "OrderedDict[Tuple[str, str, int], int]" = OrderedDict()  # key -> bytes（退避中）
+        self._total = 0
+        self._budget = get_memory_budget()
+        self._budget.register(self.OWNER, self._spill)
+
+    def get(self, data: bytes, fmt: str, quality: int) -> bytes:
+        key = (hashlib.sha256(data).hexdigest(), fmt, quality)
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is not None:
+                self._entries.move_to_end(key)
+                self._budget.touch(self.OWNER, key)
+                return hit
+            spilled = self._spilled.pop(key, None) is not None
+        encoded = read_spill(self.OWNER, key) if spilled else None
+        if encoded is None:
+            encoded = run_image_op(image_ops.encode_download, data, fmt, quality)
+        if len(encoded) > self.max_bytes:
+            return encoded
+        dropped = []
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = encoded
+                self._total += len(encoded)
+            while self._total > self.max_bytes and self._entries:
+                old, old_data = self._entries.popitem(last=False)
+                self._total -= len(old_data)
+                dropped.append(old)
+            while sum(self._spilled.values()) > self.max_bytes:  # 退避分もディスク上で同じ上限
+                dropped.append(self._spilled.popitem(last=False)[0])
+            kept = key in self._entries
+        for old in dropped:
+            self._budget.release(self.OWNER, old)
+            discard_spill(self.OWNER, old)
+        if kept:
+            self._budget.charge(self.OWNER, key, len(encoded))
+        return encoded
+
+    def _spill(self, key: Tuple[str, str, int]) -> None:
+        with self._lock:
+            encoded = self._entries.pop(key, None)
+            if encoded is None:
+                return
+            self._total -= len(encoded)
+            self._spilled[key] = len(encoded)
+        write_spill(self.OWNER, key, encoded)
+
+_encode_cache: Optional[EncodeCache] = None
+
+def encode_for_download(data: bytes, fmt: str, quality: int = 90) -> bytes:
+    """ダウンロード用に fmt へ変換したバイト列（同じ内容・形式・品質なら再エンコードしない）。"""
+    global _encode_cache
+    with _cache_lock:
+        if _encode_cache is None:
+            _encode_cache = EncodeCache(get_section("derivatives", DERIVATIVE_DEFAULTS)["encode_max_bytes"])
+    return _encode_cache.get(data, fmt, quality)
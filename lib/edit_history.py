@@ -0,0 +1,125 @@
+# lib/edit_history.py
+# セッションごとの編集履歴（生成 → 修正 → 修正 … の版をつないだ木）。
+# 各版は blob（lib/blob_store.py）のハンドルと、プロンプト・サイズ・親の版番号を持つ。
+# 元に戻す／やり直す／任意の版から分岐は辞書を引くだけで、API は呼ばない。
+from __future__ import annotations
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import streamlit as st
+
+from lib.blob_store import BlobRef
+from lib.settings import get_section
+
+# secrets.toml の [edit_history] で上書き可
+EDIT_HISTORY_DEFAULTS = {
+    "max_steps": 30,               # 1 セッションで保持する版の数
+    "max_bytes": 200_000_000,      # 1 セッションで保持する画像の合計（同じ内容は 1 回だけ数える）
+}
+
+@dataclass(frozen=True)
+class Step:
+    id: int
+    ref: BlobRef
+    action: str                    # generate / edit / upload / gallery
+    prompt: str = ""
+    size: str = ""
+    parent: Optional[int] = None   # 修正元の版（新規生成・アップロードは None）
+    created: float = field(default_factory=time.time)
+
+    def label(self) -> str:
+        text = self.prompt if len(self.prompt) <= 24 else self.prompt[:24] + "…"
+        return f"#{self.id} {self.action}" + (f"：{text}" if text else "")
+
+class EditHistory:
+    def __init__(self, max_steps: int, max_bytes: int) -> None:
+        self.max_steps = max_steps
+        self.max_bytes = max_bytes
+        self._steps: "OrderedDict[int, Step]" = OrderedDict()  # 古い順
+        self._redo: Dict[int, int] = {}  # 版 → 元に戻す前にいた子の版
+        self._next_id = 1
+        self.cursor: Optional[int] = None
+
+    @property
+    def current(self) -> Optional[Step]:
+        return self._steps.get(self.cursor) if self.cursor is not None else None
+
+    def get(self, step_id: int) -> Optional[Step]:
+        return self._steps.get(step_id)
+
+    def steps(self) -> List[Step]:
+        return list(self._steps.values())
+
+    def push(self, ref: BlobRef, *, action: str, prompt: str = "", size: str = "",
+             parent: Optional[int] = None) -> Step:
+        """新しい版を追加して現在の版にする。parent は修正元の版（送信時の cursor）。"""
+        if parent not in self._steps:  # 新規生成、または修正元が予算で捨てられた
+            parent = None
+        step = Step(self._next_id, ref, action, prompt, size, parent)
+        self._next_id += 1
+        self._steps[step.id] = step
+        if parent is not None:
+            self._redo.pop(parent, None)  # 分岐したら、前の枝へのやり直しは無効
+        self.cursor = step.id
+        self._enforce_budget()
+        return step
+
+    # ---------------- 移動（API 呼び出しなし） ----------------
+    def can_undo(self) -> bool:
+        cur = self.current
+        return cur is not None and cur.parent in self._steps
+
+    def can_redo(self) -> bool:
+        return self.cursor is not None and self._redo.get(self.cursor) in self._steps
+
+    def undo(self) -> Optional[Step]:
+        """修正元の版に戻る（戻れなければ None）。"""
+        if not self.can_undo():
+            return None
+        cur = self.current
+        self._redo[cur.parent] = cur.id
+        self.cursor = cur.parent
+        return self.current
+
+    def redo(self) -> Optional[Step]:
+        if not self.can_redo():
+            return None
+        self.cursor = self._redo[self.cursor]
+        return self.current
+
+    def checkout(self, step_id: int) -> Optional[Step]:
+        """任意の版を現在の版にする（次の修正はこの版からの分岐になる）。"""
+        if step_id not in self._steps:
+            return None
+        self.cursor = step_id
+        return self.current
+
+    def clear(self) -> None:
+        self._steps.clear()
+        self._redo.clear()
+        self.cursor = None
+
+    # ---------------- 予算 ----------------
+    def total_bytes(self) -> int:
+        return sum({s.ref.key: s.ref.size for s in self._steps.values()}.values())
+
+    def _enforce_budget(self) -> None:
+        """上限を超えたら現在の版以外を古い順に捨てる（blob は参照が消えたあと gc される）。"""
+        while len(self._steps) > 1 and (len(self._steps) > self.max_steps
+                                        or self.total_bytes() > self.max_bytes):
+            victim = next(i for i in self._steps if i != self.cursor)
+            del self._steps[victim]
+            self._redo.pop(victim, None)
+
+    def stats(self) -> dict:
+        return {"steps": len(self._steps), "bytes": self.total_bytes()}
+
+def get_history(state_key: str = "edit_history") -> EditHistory:
+    """このセッションの編集履歴（ページ 22 / 23 で共有）。"""
+    hist = st.session_state.get(state_key)
+    if hist is None:
+        cfg = get_section("edit_history", EDIT_HISTORY_DEFAULTS)
+        hist = st.session_state[state_key] = EditHistory(cfg["max_steps"], cfg["max_bytes"])
+    return hist
@@ -0,0 +1,303 @@
+# lib/fake_images_server.py
+# ============================================================
+# 🧪 負荷試験用のローカル Images API（OpenAI 互換のスタンドイン）
+# ------------------------------------------------------------
+# - POST /v1/images/generations と /v1/images/edits を実装
+# - プロンプト・サイズから決まる合成 PNG を返す（b64_json / url、output_format=webp/jpeg なら変換）
+# - url 形式の画像は形式に合った拡張子・Content-Type で配り、files_ttl 秒か files_max 件を超えたら古いものから捨てる
+# - 応答遅延（対数正規分布）・エラー率・429 注入を指定できる
+# - generations の stream=true / partial_images は SSE で途中画像を送る
+#
+# 起動:
+#   python -m lib.fake_images_server --port 8787 --latency-median 8 --rate-limit-rate 0.05
+# アプリ側（.streamlit/secrets.toml）:
+#   OPENAI_BASE_URL = "http://127.0.0.1:8787/v1"
+# ============================================================
+from __future__ import annotations
+import argparse
+import base64
+import hashlib
+import json
+import math
+import random
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from email.parser import BytesParser
+from email.policy import HTTP
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+@dataclass
+class FakeConfig:
+    latency_median: float = 5.0     # 秒（対数正規分布の中央値）
+    latency_sigma: float = 0.4      # 対数正規分布の σ（0 なら固定遅延）
+    error_rate: float = 0.0         # 500 を返す割合
+    rate_limit_rate: float = 0.0    # 429 を返す割合
+    retry_after: float = 2.0        # 429 の Retry-After 秒
+    response_format: str = "b64_json"  # リクエストで未指定のときの既定（b64_json / url）
+    seed: Optional[int] = None      # 遅延・エラー注入の乱数シード
+    files_ttl: float = 3600.0       # url 形式の画像を取りに来るのを待つ秒数
+    files_max: int = 256            # url 形式の画像を置いておく件数（超えたら古いものから捨てる）
+
+# url 形式で配るときの拡張子と Content-Type
+_FILE_TYPES = {"png": ("png", "image/png"), "webp": ("webp", "image/webp"), "jpeg": ("jpg", "image/jpeg")}
+
+# ---------------- 合成 PNG ----------------
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+@lru_cache(maxsize=64)
+def synthetic_png(key: str, size: str) -> bytes:
+    """key から決まる縦グラデーション＋横縞の RGB PNG（同じ key なら同じバイト列）。"""
+    w, h = (int(v) for v in size.lower().split("x"))
+    digest = hashlib.sha256(key.encode("utf-8")).digest()
+    c0, c1 = digest[0:3], digest[3:6]
+    stripe = 16 + digest[6] % 48
+    rows = []
+    for y in range(h):
+        t = y / max(h - 1, 1)
+        rgb = bytes(int(a + (b - a) * t) for a, b in zip(c0, c1))
+        if (y // stripe) % 2:
+            rgb = bytes(255 - v for v in rgb)
+        rows.append(b"\x00" + rgb * w)
+    raw = b"".join(rows)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 2, 0, 0, 0))
+        + _png_chunk(b"IDAT", zlib.compress(raw, 1))
+        + _png_chunk(b"IEND", b"")
+    )
+
+def encode_as(png: bytes, fmt: str, compression: int) -> bytes:
+    """output_format が webp / jpeg のときだけ PIL で変換する（png はそのまま）。"""
+    if fmt not in ("webp", "jpeg"):
+        return png
+    from io import BytesIO
+    from PIL import Image
+    buf = BytesIO()
+    Image.open(BytesIO(png)).convert("RGB").save(buf, format=fmt.upper(), quality=compression)
+    return buf.getvalue()
+
+def _output(params: Dict[str, Any]) -> Tuple[str, int]:
+    fmt = str(params.get("output_format") or "png")
+    return fmt, int(params.get("output_compression") or 100)
+
+# ---------------- リクエスト解析 ----------------
+def _parse_multipart(content_type: str, body: bytes) -> Dict[str, Any]:
+    msg = BytesParser(policy=HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + body
+    )
+    fields: Dict[str, Any] = {}
+    for part in msg.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if not name:
+            continue
+        payload = part.get_payload(decode=True) or b""
+        if part.get_filename():
+            fields.setdefault(name, payload)  # image[] が複数でも先頭だけ使う
+        else:
+            fields[name] = payload.decode("utf-8", "replace")
+    return fields
+
+class FakeImagesHandler(BaseHTTPRequestHandler):
+    server_version = "FakeImagesAPI/1.0"
+    protocol_version = "HTTP/1.1"   # keep-alive（接続プールの効果を測れるように）
+
+    @property
+    def cfg(self) -> FakeConfig:
+        return self.server.cfg  # type: ignore[attr-defined]
+
+    def log_message(self, fmt: str, *args: Any) -> None:  # 標準エラーへのアクセスログを抑制
+        pass
+
+    def _send_json(self, status: int, obj: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self) -> Tuple[str, bytes]:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.headers.get("Content-Type", ""), self.rfile.read(length)
+
+    def _inject_failure(self) -> bool:
+        rnd: random.Random = self.server.rnd  # type: ignore[attr-defined]
+        roll = rnd.random()
+        if roll < self.cfg.rate_limit_rate:
+            self._send_json(429, {"error": {"message": "Rate limit reached (fake)", "type": "requests",
+                                            "code": "rate_limit_exceeded"}},
+                            {"Retry-After": f"{self.cfg.retry_after:g}"})
+            return True
+        if roll < self.cfg.rate_limit_rate + self.cfg.error_rate:
+            self._send_json(500, {"error": {"message": "Internal error (fake)", "type": "server_error"}})
+            return True
+        return False
+
+    def _latency(self) -> float:
+        cfg = self.cfg
+        if cfg.latency_median <= 0:
+            return 0.0
+        rnd: random.Random = self.server.rnd  # type: ignore[attr-defined]
+        return cfg.latency_median * (math.exp(rnd.gauss(0.0, cfg.latency_sigma)) if cfg.latency_sigma > 0 else 1.0)
+
+    def _stream_generation(self, key: str, params: Dict[str, Any], delay: float) -> None:
+        """SSE で partial_image を遅延の途中に送り、最後に completed を送る。"""
+        size = str(params.get("size") or "1024x1024")
+        if size == "auto":
+            size = "1024x1024"
+        partials = max(0, min(3, int(params.get("partial_images") or 0)))
+        fmt, compression = _output(params)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")  # 長さ不定なので 1 応答で閉じる
+        self.end_headers()
+        self.close_connection = True
+        step = delay / (partials + 1)
+        base = {"background": "opaque", "created_at": int(time.time()), "output_format": fmt,
+                "quality": "medium", "size": size}
+
+        def send(event: str, payload: Dict[str, Any]) -> None:
+            self.wfile.write(f"event: {event}\ndata: {json.dumps(payload)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        for i in range(partials):
+            time.sleep(step)
+            png = encode_as(synthetic_png(f"{key}#partial{i}", size), fmt, compression)
+            send("image_generation.partial_image", {**base, "type": "image_generation.partial_image",
+                                                    "partial_image_index": i,
+                                                    "b64_json": base64.b64encode(png).decode("ascii")})
+        time.sleep(step)
+        png = encode_as(synthetic_png(f"{key}#0", size), fmt, compression)
+        send("image_generation.completed", {**base, "type": "image_generation.completed",
+                                            "b64_json": base64.b64encode(png).decode("ascii"),
+                                            "usage": {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0,
+                                                      "input_tokens_details": {"image_tokens": 0, "text_tokens": 0}}})
+
+    def _image_response(self, key: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        size = str(params.get("size") or "1024x1024")
+        if size == "auto":
+            size = "1024x1024"
+        n = int(params.get("n") or 1)
+        response_format = str(params.get("response_format") or self.cfg.response_format)
+        fmt, compression = _output(params)
+        data = []
+        for i in range(n):
+            png = encode_as(synthetic_png(f"{key}#{i}", size), fmt, compression)
+            if response_format == "url":
+                file_id = uuid.uuid4().hex
+                self._put_file(file_id, fmt, png)
+                host, port = self.server.server_address[:2]  # type: ignore[attr-defined]
+                ext = _FILE_TYPES.get(fmt, _FILE_TYPES["png"])[0]
+                data.append({"url": f"http://{host}:{port}/files/{file_id}.{ext}"})
+            else:
+                data.append({"b64_json": base64.b64encode(png).decode("ascii")})
+        return {"created": int(time.time()), "data": data}
+
+    def _put_file(self, file_id: str, fmt: str, data: bytes) -> None:
+        """取りに来られないまま残った古いものは、期限切れか件数超過で捨てる（挿入順＝古い順）。"""
+        files: "OrderedDict[str, Tuple[float, str, bytes]]" = self.server.files  # type: ignore[attr-defined]
+        now = time.monotonic()
+        with self.server.files_lock:  # type: ignore[attr-defined]
+            files[file_id] = (now, fmt, data)
+            while files:
+                created, _fmt, _data = next(iter(files.values()))
+                if len(files) <= self.cfg.files_max and now - created <= self.cfg.files_ttl:
+                    break
+                files.popitem(last=False)
+
+    def do_POST(self) -> None:
+        content_type, body = self._read_body()
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path.endswith("/images/generations"):
+            try:
+                params = json.loads(body or b"{}")
+            except ValueError:
+                self._send_json(400, {"error": {"message": "invalid JSON"}})
+                return
+            key = f"gen|{params.get('model')}|{params.get('prompt')}|{params.get('size')}"
+        elif path.endswith("/images/edits"):
+            params = _parse_multipart(content_type, body)
+            src = params.get("image") or params.get("image[]") or b""
+            src_hash = hashlib.sha256(src if isinstance(src, bytes) else b"").hexdigest()[:16]
+            key = f"edit|{params.get('model')}|{params.get('prompt')}|{params.get('size')}|{src_hash}"
+        else:
+            self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+        if self._inject_failure():
+            return
+        delay = self._latency()
+        if params.get("stream") in (True, "true"):
+            self._stream_generation(key, params, delay)
+            return
+        time.sleep(delay)
+        self._send_json(200, self._image_response(key, params))
+
+    def do_GET(self) -> None:
+        if not self.path.startswith("/files/"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        file_id = self.path[len("/files/"):].split(".", 1)[0]
+        with self.server.files_lock:  # type: ignore[attr-defined]
+            entry = self.server.files.pop(file_id, None)  # type: ignore[attr-defined]
+        if entry is None or time.monotonic() - entry[0] > self.cfg.files_ttl:
+            self._send_json(404, {"error": {"message": "expired"}})
+            return
+        _created, fmt, data = entry
+        self.send_response(200)
+        self.send_header("Content-Type", _FILE_TYPES.get(fmt, _FILE_TYPES["png"])[1])
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def make_server(host: str = "127.0.0.1", port: int = 8787, cfg: Optional[FakeConfig] = None) -> ThreadingHTTPServer:
+    """サーバーを作って返す（serve_forever は呼び出し側で）。port=0 で空きポート。"""
+    server = ThreadingHTTPServer((host, port), FakeImagesHandler)
+    server.daemon_threads = True
+    server.cfg = cfg or FakeConfig()  # type: ignore[attr-defined]
+    server.rnd = random.Random(server.cfg.seed)  # type: ignore[attr-defined]
+    server.files = OrderedDict()  # type: ignore[attr-defined]  # file_id -> (作成時刻, 形式, バイト列)
+    server.files_lock = threading.Lock()  # type: ignore[attr-defined]
+    return server
+
+def main(argv: Optional[list] = None) -> None:
+    ap = argparse.ArgumentParser(description="Fake OpenAI Images API for offline load testing")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8787)
+    ap.add_argument("--latency-median", type=float, default=FakeConfig.latency_median)
+    ap.add_argument("--latency-sigma", type=float, default=FakeConfig.latency_sigma)
+    ap.add_argument("--error-rate", type=float, default=FakeConfig.error_rate)
+    ap.add_argument("--rate-limit-rate", type=float, default=FakeConfig.rate_limit_rate)
+    ap.add_argument("--retry-after", type=float, default=FakeConfig.retry_after)
+    ap.add_argument("--response-format", choices=["b64_json", "url"], default=FakeConfig.response_format)
+    ap.add_argument("--seed", type=int, default=None)
+    ap.add_argument("--files-ttl", type=float, default=FakeConfig.files_ttl)
+    ap.add_argument("--files-max", type=int, default=FakeConfig.files_max)
+    args = ap.parse_args(argv)
+    cfg = FakeConfig(
+        latency_median=args.latency_median, latency_sigma=args.latency_sigma,
+        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after, response_format=args.response_format, seed=args.seed,
+        files_ttl=args.files_ttl, files_max=args.files_max,
+    )
+    server = make_server(args.host, args.port, cfg)
+    print(f"fake images api: http://{args.host}:{server.server_address[1]}/v1  ({cfg})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
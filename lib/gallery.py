@@ -0,0 +1,236 @@
+# lib/gallery.py
+# ユーザーごとのギャラリー（生成・修正した画像をセッション終了後も残す）。
+# 索引は SQLite（data/gallery/index.sqlite3）、原寸は data/gallery/blobs/ に内容アドレスで置く。
+# 一覧はサムネイルだけを索引から引き、キーセット方式（ts, id）でページ送りするので
+# 件数が増えても 1 ページ分の行しか読まず、原寸はダウンロード時にしか開かない。
+# 各画像の知覚ハッシュ（lib/image_hash.py）も持ち、ユーザーごとのハミング距離索引で似た画像を引く。
+from __future__ import annotations
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from lib.blob_store import BlobRef, get_blob_store
+from lib.derivatives import get_derivatives
+from lib.image_hash import IMAGE_HASH_DEFAULTS, HammingIndex, from_sql, hamming, image_hashes, to_sql
+from lib.settings import data_dir, get_section
+
+# secrets.toml の [gallery] で上書き可
+GALLERY_DEFAULTS = {
+    "enabled": True,
+    "page_size": 24,             # 1 ページの枚数
+    "columns": 4,
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id          INTEGER PRIMARY KEY,
+    user        TEXT NOT NULL,
+    ts          REAL NOT NULL,
+    action      TEXT NOT NULL,
+    model       TEXT,
+    size        TEXT,
+    prompt_hash TEXT,
+    blob        TEXT NOT NULL,
+    fmt         TEXT,
+    width       INTEGER,
+    height      INTEGER,
+    bytes       INTEGER
+);
+CREATE INDEX IF NOT EXISTS images_user_ts ON images (user, ts DESC, id DESC);
+CREATE INDEX IF NOT EXISTS images_blob ON images (blob);
+CREATE TABLE IF NOT EXISTS thumbs (
+    blob TEXT PRIMARY KEY,
+    mime TEXT NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS hashes (
+    blob  TEXT PRIMARY KEY,
+    phash INTEGER NOT NULL,
+    dhash INTEGER NOT NULL
+);
+"""
+
+_SELECT = ("SELECT i.id, i.user, i.ts, i.action, i.model, i.size, i.prompt_hash, i.blob, i.fmt,"
+           " i.width, i.height, i.bytes, t.data, t.mime FROM images i JOIN thumbs t ON t.blob = i.blob")
+
+@dataclass(frozen=True)
+class GalleryItem:
+    id: int
+    user: str
+    ts: float
+    action: str
+    model: str
+    size: str
+    prompt_hash: str
+    blob: str                    # 原寸の sha256
+    fmt: str
+    width: int
+    height: int
+    bytes: int
+    thumb: bytes
+    thumb_mime: str
+
+    @property
+    def cursor(self) -> Tuple[float, int]:
+        """この行より古いページを引くためのキー。"""
+        return (self.ts, self.id)
+
+class Gallery:
+    def __init__(self, root: Path) -> None:
+        self.blobs = root / "blobs"
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(root / "index.sqlite3"), check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._trees: Dict[str, HammingIndex] = {}  # user -> pHash の索引（値は (blob, dHash)）。初回の検索時に作る
+        self._tree_lock = threading.Lock()
+
+    def _blob_path(self, key: str) -> Path:
+        return self.blobs / key[:2] / key
+
+    def _keep_blob(self, ref: BlobRef) -> None:
+        """セッション用ブロブをギャラリー側にも置く（可能ならハードリンクで、容量を増やさない）。"""
+        dst = self._blob_path(ref.key)
+        if dst.exists():
+            return
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        src = get_blob_store().path(ref.key)
+        tmp = dst.with_suffix(f".{threading.get_ident()}.tmp")
+        try:
+            os.link(src, tmp)
+        except OSError:  # 別ファイルシステムなど
+            shutil.copyfile(src, tmp)
+        tmp.replace(dst)
+
+    def add(self, user: str, ref: BlobRef, *, action: str, model: str = "", size: str = "",
+            prompt_hash: str = "") -> int:
+        """画像を 1 枚登録して行 ID を返す。サムネイルは派生画像キャッシュのものを保存する。"""
+        self._keep_blob(ref)
+        der = get_derivatives(ref)
+        (phash, dhash), = image_hashes([der.thumb])
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("INSERT OR IGNORE INTO thumbs (blob, mime, data) VALUES (?, ?, ?)",
+                                   (ref.key, der.mime, der.thumb))
+                cur = self._conn.execute(
+                    "INSERT INTO images (user, ts, action, model, size, prompt_hash, blob, fmt,"
+                    " width, height, bytes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (user, time.time(), action, model, size, prompt_hash, ref.key, ref.fmt,
+                     der.width, der.height, ref.size))
+                self._conn.execute("INSERT OR IGNORE INTO hashes (blob, phash, dhash) VALUES (?, ?, ?)",
+                                   (ref.key, to_sql(phash), to_sql(dhash)))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        with self._tree_lock:
+            tree = self._trees.get(user)
+            if tree is not None:
+                tree.add(phash, (ref.key, dhash))
+        return cur.lastrowid
+
+    def page(self, user: str, before: Optional[Tuple[float, int]] = None, limit: int = 24) -> List[GalleryItem]:
+        """user の画像を新しい順に limit 件。before を渡すとそれより古いものから（キーセット方式）。"""
+        sql = _SELECT + " WHERE i.user = ?"
+        params: list = [user]
+        if before is not None:
+            sql += " AND (i.ts, i.id) < (?, ?)"
+            params += list(before)
+        sql += " ORDER BY i.ts DESC, i.id DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [GalleryItem(*row) for row in rows]
+
+    def count(self, user: str) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM images WHERE user = ?", (user,)).fetchone()[0]
+
+    def find(self, key: str, user: Optional[str] = None) -> Optional[GalleryItem]:
+        """画像 key（sha256）の最新の登録（ギャラリーに無ければ None）。user を渡すとその人の分だけ。"""
+        sql = _SELECT + " WHERE i.blob = ?"
+        params: list = [key]
+        if user is not None:
+            sql += " AND i.user = ?"
+            params.append(user)
+        with self._lock:
+            row = self._conn.execute(sql + " ORDER BY i.id DESC LIMIT 1", params).fetchone()
+        return GalleryItem(*row) if row else None
+
+    # ---------------- 似た画像 ----------------
+    def _tree(self, user: str) -> HammingIndex:
+        """user の索引（初回は索引から作る。ハッシュの無い古い行はここで計算して保存する）。"""
+        with self._tree_lock:
+            tree = self._trees.get(user)
+            if tree is not None:
+                return tree
+            with self._lock:
+                missing = self._conn.execute(
+                    "SELECT DISTINCT t.blob, t.data FROM images i JOIN thumbs t ON t.blob = i.blob"
+                    " LEFT JOIN hashes h ON h.blob = i.blob WHERE i.user = ? AND h.blob IS NULL",
+                    (user,)).fetchall()
+            for start in range(0, len(missing), 256):
+                chunk = missing[start:start + 256]
+                rows = [(blob, to_sql(p), to_sql(d))
+                        for (blob, _data), (p, d) in zip(chunk, image_hashes([data for _b, data in chunk]))]
+                with self._lock:
+                    self._conn.executemany("INSERT OR IGNORE INTO hashes (blob, phash, dhash) VALUES (?, ?, ?)",
+                                           rows)
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT DISTINCT h.blob, h.phash, h.dhash FROM images i JOIN hashes h ON h.blob = i.blob"
+                    " WHERE i.user = ?", (user,)).fetchall()
+            tree = self._trees[user] = HammingIndex((from_sql(p), (blob, from_sql(d))) for blob, p, d in rows)
+            return tree
+
+    def similar(self, user: str, ref: BlobRef, *, max_distance: Optional[int] = None,
+                limit: Optional[int] = None) -> List[Tuple[int, GalleryItem]]:
+        """user のギャラリーから ref に似た画像を (pHash の距離, 項目) で近い順に。ref 自身は除く。"""
+        cfg = get_section("image_hash", IMAGE_HASH_DEFAULTS)
+        max_distance = cfg["max_distance"] if max_distance is None else max_distance
+        limit = cfg["limit"] if limit is None else limit
+        with self._lock:
+            row = self._conn.execute("SELECT phash, dhash FROM hashes WHERE blob = ?", (ref.key,)).fetchone()
+        if row is not None:
+            phash, dhash = from_sql(row[0]), from_sql(row[1])
+        else:
+            (phash, dhash), = image_hashes([get_derivatives(ref).thumb])
+        seen = {ref.key}
+        ranked = []
+        for d, (blob, other_dhash) in self._tree(user).search(phash, max_distance):
+            if blob in seen:
+                continue
+            seen.add(blob)
+            ranked.append((d, hamming(dhash, other_dhash), blob))  # 同じ距離なら dHash の近い順
+        ranked.sort()
+        out = []
+        for d, _dd, blob in ranked[:limit]:
+            item = self.find(blob, user)
+            if item is not None:
+                out.append((d, item))
+        return out
+
+    def read(self, key: str) -> bytes:
+        """原寸（ダウンロード・修正元にするときだけ読む）。"""
+        return self._blob_path(key).read_bytes()
+
+_gallery: Optional[Gallery] = None
+_gallery_lock = threading.Lock()
+
+def get_gallery() -> Optional[Gallery]:
+    """[gallery] enabled=false なら None。"""
+    global _gallery
+    if not get_section("gallery", GALLERY_DEFAULTS)["enabled"]:
+        return None
+    with _gallery_lock:
+        if _gallery is None:
+            _gallery = Gallery(data_dir("gallery"))
+        return _gallery
@@ -0,0 +1,214 @@
+# lib/image_api.py
+# Images API 呼び出し（generate / edit）の共通処理。
+# ジョブスレッドから呼ばれるので st.* は使わない。
+from __future__ import annotations
+import dataclasses
+import hashlib
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import httpx
+from openai import AsyncOpenAI
+
+from lib.image_utils import (IMAGE_FORMATS, as_named_file, b64decode_image, ensure_image_bytes, image_ext,
+                             url_to_bytes)
+from lib.jobs import (Job, JobCancelled, cancellable_sleep, current_job,
+                      set_job_preview, set_job_progress)
+from lib.openai_client import request_timeout, run_on_api_loop
+from lib.rate_limit import get_rate_limiter
+from lib.result_cache import cache_key, get_result_cache
+from lib.retry import call_with_retry
+from lib.singleflight import get_singleflight
+
+DEFAULT_MODEL = "gpt-image-1"
+
+# 出力形式（secrets.toml の [image_output] で上書き可）
+OUTPUT_DEFAULTS = {
+    "output_format": "png",      # png / webp / jpeg
+    "output_compression": 80,    # webp / jpeg の圧縮（0〜100、大きいほど高画質）
+    "user_selectable": True,     # False ならページに選択肢を出さず上の既定で固定
+}
+
+class EmptyImageResponse(RuntimeError):
+    """API 応答に画像（b64_json / url）が含まれていなかった。"""
+
+@dataclass
+class ImageResult:
+    data: bytes             # API が返した形式のまま（png / webp / jpeg）
+    fmt: str = "png"
+    retries: int = 0        # 一時エラーによる再試行回数
+    coalesced: bool = False  # 同一リクエストに相乗りした（API を呼んでいない）
+    cached: bool = False     # 結果キャッシュから返した（API を呼んでいない）
+
+    @property
+    def billable(self) -> bool:
+        return not (self.coalesced or self.cached)
+
+    @property
+    def mime(self) -> str:
+        return IMAGE_FORMATS[self.fmt][0]
+
+    def log_fields(self) -> Dict[str, Any]:
+        """JSONL ログに足す項目（pages/99 の課金集計は billable を見る）。"""
+        return {"retries": self.retries, "coalesced": self.coalesced,
+                "cached": self.cached, "billable": self.billable,
+                "output_format": self.fmt, "bytes": len(self.data)}
+
+def _format_params(fmt: str, compression: int) -> Dict[str, Any]:
+    """Images API に渡す出力形式（png は従来どおり何も付けない）。"""
+    if fmt == "png":
+        return {}
+    return {"output_format": fmt, "output_compression": compression}
+
+def _format_tag(fmt: str, compression: int) -> str:
+    """相乗り・キャッシュのキーに足す出力形式（png は空＝従来のキーのまま）。"""
+    return "" if fmt == "png" else f"{fmt}:{compression}"
+
+def _show_wait(position: int, eta: float) -> None:
+    set_job_progress(f"混雑のため順番待ち中：{position} 番目（あと約 {eta:.0f} 秒）")
+
+def _show_retry(attempt: int, delay: float, exc: BaseException) -> None:
+    set_job_progress(f"一時的なエラーのため {delay:.0f} 秒後に再試行します（{attempt} 回目: {type(exc).__name__}）")
+
+def _call(user: str, op: str, request: Callable[[httpx.Timeout], Awaitable[Any]]) -> Tuple[Any, int]:
+    """リミッタの枠を取って API ループで request() を実行する。
+
+    一時エラーは枠を返してから再試行。ジョブのキャンセルで実行中の呼び出しも中断する。
+    """
+    timeout, total = request_timeout(op)
+    job = current_job()
+
+    def attempt() -> Any:
+        with get_rate_limiter().slot(user, on_wait=_show_wait):
+            set_job_progress("")
+            return run_on_api_loop(request(timeout), total=total, job=job)
+    return call_with_retry(attempt, on_retry=_show_retry, sleep=cancellable_sleep)
+
+def _show_join() -> None:
+    set_job_progress("同じ内容のリクエストが実行中のため、その結果を共有します")
+
+def _check_cancelled() -> None:
+    job = current_job()
+    if job is not None:
+        job.check_cancelled()
+
+def _coalesce(key: Tuple[Any, ...], run: Callable[[], ImageResult]) -> ImageResult:
+    """同一内容の同時リクエストを 1 回の API 呼び出しにまとめる。"""
+    while True:
+        try:
+            result, shared = get_singleflight().do(key, run, on_join=_show_join,
+                                                   wait_check=_check_cancelled)
+        except JobCancelled:
+            job = current_job()
+            if job is None or job.cancel_requested.is_set():
+                raise
+            continue  # 先行リクエストの側がキャンセルされた → 自分で実行し直す
+        if shared:
+            return dataclasses.replace(result, retries=0, coalesced=True)
+        return result
+
+def _with_cache(key_parts: Tuple[Any, ...], use_cache: bool, run: Callable[[], ImageResult],
+                variant: int = 0, fmt: str = "png", tag: str = "") -> ImageResult:
+    """use_cache かつキャッシュ有効なら、命中時は API を呼ばずに返す。"""
+    cache = get_result_cache() if use_cache else None
+    if cache is None:
+        return run()
+    key = cache_key(*key_parts, variant=variant, fmt=tag)
+    hit = cache.get(key)
+    if hit is not None:
+        return ImageResult(data=hit, fmt=fmt, cached=True)
+    result = run()
+    cache.put(key, result.data)
+    return result
+
+def _datum_to_bytes(datum, fmt: str) -> bytes:
+    if getattr(datum, "b64_json", None):
+        data = b64decode_image(datum.b64_json)
+        datum.b64_json = None  # 復号前の文字列（画像の約 1.33 倍）を早めに手放す
+        # 要求した形式ならヘッダだけ検証してそのまま使う（デコード・再エンコードしない）
+        return ensure_image_bytes(data, fmt)
+    if getattr(datum, "url", None):
+        return ensure_image_bytes(url_to_bytes(datum.url), fmt)
+    raise EmptyImageResponse("画像が返ってきませんでした。")
+
+class _Final:
+    """ストリームの完了イベントを images.generate の data[0] と同じ形で扱う。"""
+    def __init__(self, b64_json: Optional[str]) -> None:
+        self.b64_json = b64_json
+        self.url = None
+
+async def _stream_generate(client: AsyncOpenAI, *, model: str, prompt: str, size: str,
+                           partial_images: int, timeout: httpx.Timeout, job: Optional[Job],
+                           **format_params: Any) -> _Final:
+    """partial_images を受け取るたびにジョブのプレビューを差し替え、最終画像を返す。"""
+    stream = await client.images.generate(model=model, prompt=prompt, n=1, size=size,
+                                          stream=True, partial_images=partial_images, timeout=timeout,
+                                          **format_params)
+    final: Optional[str] = None
+    async for event in stream:
+        if event.type == "image_generation.partial_image":
+            set_job_preview(b64decode_image(event.b64_json), job=job)
+            set_job_progress(f"プレビュー受信 {event.partial_image_index + 1}/{partial_images}", job=job)
+        elif event.type == "image_generation.completed":
+            final = event.b64_json
+    return _Final(final)
+
+async def _generate_once(client: AsyncOpenAI, *, model: str, prompt: str, size: str,
+                         timeout: httpx.Timeout, **format_params: Any) -> Any:
+    res = await client.images.generate(model=model, prompt=prompt, n=1, size=size, timeout=timeout,
+                                       **format_params)
+    return res.data[0]
+
+def generate_png(client: AsyncOpenAI, *, prompt: str, size: str, model: str = DEFAULT_MODEL,
+                 user: str = "", use_cache: bool = False, partial_images: int = 0,
+                 variant: int = 0, output_format: str = "png",
+                 output_compression: int = 100) -> ImageResult:
+    """partial_images > 0 ならストリーミングで途中経過を受け取る（1〜3）。
+
+    複数枚を並列生成するときは variant に 0, 1, 2… を渡し、相乗り・キャッシュを別扱いにする。
+    output_format（png / webp / jpeg）の結果は PNG に戻さずそのまま返す。
+    """
+    job = current_job()
+    fmt_params = _format_params(output_format, output_compression)
+    tag = _format_tag(output_format, output_compression)
+
+    def request(timeout: httpx.Timeout) -> Awaitable[Any]:
+        if partial_images > 0:
+            return _stream_generate(client, model=model, prompt=prompt, size=size,
+                                    partial_images=partial_images, timeout=timeout, job=job, **fmt_params)
+        return _generate_once(client, model=model, prompt=prompt, size=size, timeout=timeout, **fmt_params)
+
+    def run() -> ImageResult:
+        datum, retries = _call(user, "generate", request)
+        return ImageResult(data=_datum_to_bytes(datum, output_format), fmt=output_format, retries=retries)
+    return _with_cache(("generate", model, prompt, size), use_cache,
+                       lambda: _coalesce(("generate", model, prompt, size, variant, tag), run),
+                       variant=variant, fmt=output_format, tag=tag)
+
+def edit_png(client: AsyncOpenAI, *, src_png: bytes, prompt: str, size: str,
+             model: str = DEFAULT_MODEL, user: str = "", use_cache: bool = False,
+             output_format: str = "png", output_compression: int = 100) -> ImageResult:
+    """src_png は png / webp / jpeg のどれでもよい（前回の結果をそのまま渡せる）。"""
+    fmt_params = _format_params(output_format, output_compression)
+    tag = _format_tag(output_format, output_compression)
+    filename = f"image.{image_ext(src_png)}"  # SDK はファイル名から MIME を決める
+
+    def request(timeout: httpx.Timeout) -> Awaitable[Any]:
+        # メモリ上のバイト列から直接送る（一時ファイルを書かない）。試行ごとに新しいバッファ
+        return client.images.edit(
+            model=model,
+            image=as_named_file(src_png, filename),
+            prompt=prompt,
+            size=size,
+            timeout=timeout,
+            **fmt_params,
+        )
+
+    def run() -> ImageResult:
+        res, retries = _call(user, "edit", request)
+        return ImageResult(data=_datum_to_bytes(res.data[0], output_format), fmt=output_format,
+                           retries=retries)
+    src_hash = hashlib.sha256(src_png).hexdigest()
+    return _with_cache(("edit", model, prompt, size, src_hash), use_cache,
+                       lambda: _coalesce(("edit", model, prompt, size, src_hash, tag), run),
+                       fmt=output_format, tag=tag)
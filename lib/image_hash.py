@@ -0,0 +1,113 @@
+# lib/image_hash.py
+# 知覚ハッシュ（pHash / dHash、各 64 ビット）と、ハミング距離で近傍を引く索引（multi-index hashing）。
+# ハッシュは派生画像のサムネイル（長辺 256px）から作るので原寸はデコードしない。
+# 複数枚はまとめて NumPy で計算する（DCT は行列積 1 回で全枚数ぶん）。
+from __future__ import annotations
+from io import BytesIO
+from itertools import combinations
+from typing import Any, Dict, Iterable, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+# secrets.toml の [image_hash] で上書き可（lib/gallery.py の similar() が使う）
+IMAGE_HASH_DEFAULTS = {
+    "enabled": True,
+    "max_distance": 10,          # pHash のハミング距離（64 ビット中）がこれ以下なら「似ている」
+    "limit": 8,                  # 表示する件数
+}
+
+_DCT_N = 32
+# 1 次元 DCT-II の基底（32x32）。2 次元 DCT は D @ X @ D.T
+_DCT = np.cos(np.pi * (2 * np.arange(_DCT_N)[None, :] + 1) * np.arange(_DCT_N)[:, None] / (2 * _DCT_N))
+
+def _gray(data: bytes, size: Tuple[int, int]) -> np.ndarray:
+    img = Image.open(BytesIO(data))
+    img.draft("L", size)
+    return np.asarray(img.convert("L").resize(size, Image.Resampling.BILINEAR), dtype=np.float32)
+
+def _pack(bits: np.ndarray) -> List[int]:
+    """(N, 64) の真偽値 → 64 ビット整数 N 個。"""
+    packed = np.packbits(bits.reshape(len(bits), 64), axis=1)
+    return [int.from_bytes(row.tobytes(), "big") for row in packed]
+
+def image_hashes(thumbs: List[bytes]) -> List[Tuple[int, int]]:
+    """サムネイル（PNG/WebP/JPEG のバイト列）ごとの (pHash, dHash)。"""
+    if not thumbs:
+        return []
+    big = np.stack([_gray(t, (_DCT_N, _DCT_N)) for t in thumbs])         # (N, 32, 32)
+    dct = _DCT @ big @ _DCT.T                                              # (N, 32, 32)
+    low = dct[:, :8, :8].reshape(len(thumbs), 64)
+    med = np.median(low[:, 1:], axis=1, keepdims=True)                     # 直流成分は除いて中央値
+    phash = _pack(low > med)
+    small = np.stack([_gray(t, (9, 8)) for t in thumbs])                 # (N, 8, 9)
+    dhash = _pack(small[:, :, 1:] > small[:, :, :-1])
+    return list(zip(phash, dhash))
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+def to_sql(h: int) -> int:
+    """SQLite の INTEGER（符号付き 64 ビット）に入れるための変換。"""
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+def from_sql(v: int) -> int:
+    return v + (1 << 64) if v < 0 else v
+
+class HammingIndex:
+    """ハミング距離の近傍検索（multi-index hashing）。
+
+    64 ビットを 16 ビットずつ 4 つに分け、部分ごとに辞書を持つ。距離 r 以内なら鳩の巣原理で
+    どれかの部分が r // 4 ビット以内の差なので、その範囲の値だけを引いて候補にし、全体の距離で確かめる。
+    """
+    _CHUNKS = 4
+    _BITS = 16
+
+    def __init__(self, items: Iterable[Tuple[int, Any]] = ()) -> None:
+        self._tables: List[Dict[int, List[int]]] = [{} for _ in range(self._CHUNKS)]
+        self._hashes: List[int] = []
+        self._values: List[Any] = []
+        for h, value in items:
+            self.add(h, value)
+
+    @property
+    def size(self) -> int:
+        return len(self._hashes)
+
+    def _parts(self, h: int) -> List[int]:
+        mask = (1 << self._BITS) - 1
+        return [(h >> (i * self._BITS)) & mask for i in range(self._CHUNKS)]
+
+    def add(self, h: int, value: Any) -> None:
+        idx = len(self._hashes)
+        self._hashes.append(h)
+        self._values.append(value)
+        for table, part in zip(self._tables, self._parts(h)):
+            table.setdefault(part, []).append(idx)
+
+    def search(self, h: int, radius: int) -> List[Tuple[int, Any]]:
+        """距離 radius 以内の (距離, 値) を近い順に。"""
+        flips = _flip_masks(self._BITS, radius // self._CHUNKS)
+        candidates = set()
+        for table, part in zip(self._tables, self._parts(h)):
+            for m in flips:
+                hit = table.get(part ^ m)
+                if hit:
+                    candidates.update(hit)
+        found = []
+        for idx in candidates:
+            d = hamming(h, self._hashes[idx])
+            if d <= radius:
+                found.append((d, self._values[idx]))
+        found.sort(key=lambda x: x[0])
+        return found
+
+_FLIPS: Dict[Tuple[int, int], List[int]] = {}
+
+def _flip_masks(bits: int, k: int) -> List[int]:
+    """bits ビット中 k ビット以下を反転するマスク全部（0 を含む）。"""
+    key = (bits, k)
+    if key not in _FLIPS:
+        _FLIPS[key] = [sum(1 << b for b in combo)
+                       for n in range(k + 1) for combo in combinations(range(bits), n)]
+    return _FLIPS[key]
@@ -0,0 +1,148 @@
+# lib/image_ops.py
+# CPU を食う画像処理（デコード・縮小・エンコード）の本体。
+# lib/image_workers.py の子プロセスでも import するので、PIL 以外（streamlit 等）に依存しない。
+from __future__ import annotations
+from io import BytesIO
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+# EXIF Orientation → 正しい向きに戻す変換（ImageOps.exif_transpose と同じ対応）
+_EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# 変換しながら縮小するときの帯 1 本の画素数の目安（RGBA で 4MB ほど）
+_STRIP_PIXELS = 1_000_000
+
+def _open(data: bytes) -> Image.Image:
+    img = Image.open(BytesIO(data))
+    img.load()
+    return img
+
+def _has_alpha(img: Image.Image) -> bool:
+    return img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+
+def _save(img: Image.Image, fmt: str, **params) -> bytes:
+    if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+        if _has_alpha(img):  # JPEG は透過を白で埋める
+            rgba = img.convert("RGBA")
+            bg = Image.new("RGB", rgba.size, "white")
+            bg.paste(rgba, mask=rgba.getchannel("A"))
+            img = bg
+        else:
+            img = img.convert("RGB")
+    buf = BytesIO()
+    img.save(buf, format=fmt.upper(), **params)
+    return buf.getvalue()
+
+def transcode(data: bytes, fmt: str, quality: int = 90) -> bytes:
+    return _save(_open(data), fmt, quality=quality)
+
+def encode_download(data: bytes, fmt: str, quality: int = 90) -> bytes:
+    """fmt=png は optimize=True の PNG、それ以外は quality 指定の非可逆。"""
+    if fmt == "png":
+        return _save(_open(data), "png", optimize=True)
+    return _save(_open(data), fmt, quality=quality)
+
+def previews(data: bytes, sizes: Tuple[int, ...], fmt: str, quality: int) -> Tuple[List[bytes], Dict[str, int]]:
+    """長辺 sizes[i] px の縮小版を fmt で作る。デコードは 1 回だけ。"""
+    img = _open(data)
+    outs = []
+    for max_px in sizes:
+        small = img.copy()
+        small.thumbnail((max_px, max_px), reducing_gap=2.0)
+        outs.append(_save(small, fmt, quality=quality))
+    return outs, {"width": img.width, "height": img.height}
+
+def _convert_reduced(img: Image.Image, mode: str, factor: int) -> Image.Image:
+    """img.convert(mode).reduce(factor) と同じ結果を、原寸の mode 版を丸ごと作らずに得る。
+
+    factor の倍数行ずつの帯に切って変換・縮小し、縮小後の画像に貼る（帯の境目で平均する
+    ブロックがまたがらないので結果は変わらない）。P / 1 / I;16 など reduce() が扱えない
+    モードの大きな画像でも、原寸で持つのは元のモードの画素だけになる。
+    """
+    w, h = img.size
+    out = Image.new(mode, (-(-w // factor), -(-h // factor)))
+    rows = max(1, _STRIP_PIXELS // (w * factor)) * factor
+    for top in range(0, h, rows):
+        strip = img.crop((0, top, w, min(h, top + rows))).convert(mode).reduce(factor)
+        out.paste(strip, (0, top // factor))
+    return out
+
+def normalize_upload(data: bytes, max_side: int) -> bytes:
+    """長辺 max_side 以下の PNG にする（EXIF の向きを反映、透過が無ければ RGB）。
+
+    JPEG は draft で縮小しながらデコードし、その他は reduce() で整数分の 1 に落としてから
+    仕上げの縮小をするので、巨大な写真でもメモリと CPU は出力サイズ程度で済む。
+    """
+    img = Image.open(BytesIO(data))
+    orientation = img.getexif().get(0x0112, 1)
+    w, h = img.size
+    scale = min(1.0, max_side / max(w, h))
+    if img.format == "JPEG" and scale < 1.0:
+        img.draft("RGB", (max(1, int(w * scale)), max(1, int(h * scale))))
+    img.load()
+    target = "RGBA" if _has_alpha(img) else "RGB"
+    factor = int(max(img.size) / max_side)
+    if factor >= 2:
+        # 出力のモードへは縮小しながら帯ごとに変換する（原寸の RGB / RGBA 版は作らない）
+        img = img.reduce(factor) if img.mode == target else _convert_reduced(img, target, factor)
+    elif img.mode != target:
+        img = img.convert(target)
+    if max(img.size) > max_side:
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    if orientation in _EXIF_TRANSPOSE:
+        img = img.transpose(_EXIF_TRANSPOSE[orientation])
+    return _save(img, "png")
+
+# ---------------- 子プロセス側（共有メモリでの受け渡し） ----------------
+OPS: Dict[str, Callable[..., Any]] = {
+    "transcode": transcode,
+    "encode_download": encode_download,
+    "previews": previews,
+    "normalize_upload": normalize_upload,
+}
+
+def attach_shm(name: Optional[str], size: int = 0, create: bool = False) -> shared_memory.SharedMemory:
+    """後始末（unlink）は親プロセスがするので、このプロセスの resource_tracker には登録しない。"""
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:  # Python 3.12 以前は track 引数が無い
+        shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore[attr-defined]
+        return shm
+
+def run_shm_op(op: str, in_name: str, in_len: int,
+               args: tuple) -> Tuple[Optional[str], List[int], Any, bool]:
+    """共有メモリ in_name の入力に OPS[op] を適用し、出力を新しい共有メモリに書いて返す。
+
+    戻り値は (出力の共有メモリ名, 各出力の長さ, 付帯情報, 戻り値がタプルだったか)。
+    """
+    shm = attach_shm(in_name)
+    try:
+        data = bytes(shm.buf[:in_len])
+    finally:
+        shm.close()
+    result = OPS[op](data, *args)
+    packed = isinstance(result, tuple)
+    outs, meta = result if packed else ([result], None)
+    total = sum(len(o) for o in outs)
+    if total == 0:
+        return None, [0] * len(outs), meta, packed
+    out = attach_shm(None, size=total, create=True)
+    try:
+        pos = 0
+        for o in outs:
+            out.buf[pos:pos + len(o)] = o
+            pos += len(o)
+        return out.name, [len(o) for o in outs], meta, packed
+    finally:
+        out.close()
@@ -1,33 +1,124 @@
 # lib/image_utils.py
 from __future__ import annotations
-import base64
+import binascii
+import struct
+import zlib
 from io import BytesIO
-from typing import List
-from urllib.request import urlopen
+from typing import List, NamedTuple
 
 from PIL import Image, ImageOps
 
+from lib import image_ops
+from lib.image_workers import run_image_op
+from lib.url_fetch import fetch_bytes
+
 def pil_open(file) -> Image.Image:
     img = Image.open(file)
     img = ImageOps.exif_transpose(img)
     return img.convert("RGBA")
 
+UPLOAD_MAX_SIDE = 1536  # Images API の最大辺（これより大きく送っても使われない）
+
+def normalize_upload(file, max_side: int = UPLOAD_MAX_SIDE) -> bytes:
+    """アップロード画像を長辺 max_side 以下の PNG にする（EXIF の向きを反映）。
+
+    JPEG は draft で縮小しながらデコードし、その他は reduce() で整数分の 1 に落としてから
+    仕上げの縮小をするので、巨大な写真でもメモリと CPU は出力サイズ程度で済む。
+    透過が無ければ RGB のまま（RGBA に広げない）。処理はプロセスプールで行う。
+    """
+    data = file.getvalue() if hasattr(file, "getvalue") else file.read()
+    return run_image_op(image_ops.normalize_upload, data, max_side)
+
 def pil_to_png_bytes(img: Image.Image) -> bytes:
     buf = BytesIO()
     img.save(buf, format="PNG")
     return buf.getvalue()
 
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+MAX_PNG_SIDE = 16384  # これを超える IHDR は壊れているとみなす
+
+class PngHeader(NamedTuple):
+    width: int
+    height: int
+    bit_depth: int
+    color_type: int  # 2=RGB, 6=RGBA など
+
+def png_header(data: bytes) -> PngHeader:
+    """PNG シグネチャと IHDR チャンク（長さ・CRC・値の範囲）を検証して返す。
+
+    画素はデコードしない。PNG でなければ ValueError。
+    """
+    if len(data) < 33 or data[:8] != PNG_SIGNATURE:
+        raise ValueError("PNG シグネチャがありません。")
+    length, tag = struct.unpack(">I4s", data[8:16])
+    if tag != b"IHDR" or length != 13:
+        raise ValueError("IHDR チャンクがありません。")
+    (crc,) = struct.unpack(">I", data[29:33])
+    if zlib.crc32(data[12:29]) & 0xFFFFFFFF != crc:
+        raise ValueError("IHDR の CRC が一致しません。")
+    width, height, bit_depth, color_type, _comp, _filter, _interlace = struct.unpack(">IIBBBBB", data[16:29])
+    if not (0 < width <= MAX_PNG_SIDE and 0 < height <= MAX_PNG_SIDE):
+        raise ValueError(f"画像サイズが不正です: {width}x{height}")
+    if color_type not in (0, 2, 3, 4, 6) or bit_depth not in (1, 2, 4, 8, 16):
+        raise ValueError("IHDR の色形式が不正です。")
+    return PngHeader(width, height, bit_depth, color_type)
+
+# 出力形式（Images API の output_format と同じ名前）→ (MIME, 拡張子)
+IMAGE_FORMATS = {"png": ("image/png", "png"), "webp": ("image/webp", "webp"), "jpeg": ("image/jpeg", "jpg")}
+
+def sniff_format(data: bytes) -> str:
+    """先頭のマジックバイトから png / webp / jpeg を判定する（不明なら空文字）。"""
+    if data[:8] == PNG_SIGNATURE:
+        return "png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    return ""
+
+def image_mime(data: bytes) -> str:
+    return IMAGE_FORMATS.get(sniff_format(data), IMAGE_FORMATS["png"])[0]
+
+def image_ext(data: bytes) -> str:
+    return IMAGE_FORMATS.get(sniff_format(data), IMAGE_FORMATS["png"])[1]
+
+def ensure_image_bytes(data: bytes, fmt: str = "png", quality: int = 90) -> bytes:
+    """data が fmt 形式ならそのまま返す（再エンコードしない）。違う形式のときだけ変換する。"""
+    if sniff_format(data) == fmt:
+        if fmt != "png":
+            return data
+        try:
+            png_header(data)
+            return data
+        except ValueError:
+            pass
+    return run_image_op(image_ops.transcode, data, fmt, quality)
+
+def ensure_png_bytes(data: bytes) -> bytes:
+    """PNG ならそのまま返す（再エンコードしない）。それ以外の形式だけ PNG に変換する。"""
+    return ensure_image_bytes(data, "png")
+
+def b64decode_image(b64data: str) -> bytes:
+    """b64_json を 1 回のコピーでバイト列にする。
+
+    base64.b64decode(str) は一度 ASCII の bytes に写してから復号するので、
+    ペイロード分の中間コピーが余計にできる。binascii は str を直接読む。
+    """
+    return binascii.a2b_base64(b64data)
+
 def b64_to_pil(b64data: str) -> Image.Image:
-    raw = base64.b64decode(b64data)
-    return Image.open(BytesIO(raw)).convert("RGBA")
+    raw = b64decode_image(b64data)
+    return Image.open(BytesIO(raw)).convert("RGBA")  # BytesIO は raw をコピーしない
+
+def url_to_bytes(url: str) -> bytes:
+    """共有プール・タイムアウト・サイズ上限つきで取得する（lib/url_fetch.py）。"""
+    return fetch_bytes(url)
 
 def url_to_png_bytes(url: str) -> bytes:
-    with urlopen(url) as resp:
-        data = resp.read()
-    img = Image.open(BytesIO(data)).convert("RGBA")
-    return pil_to_png_bytes(img)
+    return ensure_png_bytes(url_to_bytes(url))  # PNG ならそのまま（再エンコードしない）
 
 def as_named_file(data: bytes, filename: str) -> BytesIO:
+    # BytesIO(bytes) は書き込むまで元のバッファを共有する（コピーしない）
     bio = BytesIO(data)
     bio.name = filename  # OpenAI Images API がMIME推定に使用
     bio.seek(0)
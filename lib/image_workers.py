@@ -0,0 +1,105 @@
+# lib/image_workers.py
+# CPU を食う画像処理をプロセスプールで実行する（GIL を他セッションと取り合わない）。
+# 入出力のバイト列は共有メモリで受け渡し、プールが使えないときはその場で実行する。
+from __future__ import annotations
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Any, Callable, List, Optional
+
+from lib import image_ops
+from lib.settings import get_section
+
+# secrets.toml の [image_workers] で上書き可
+IMAGE_WORKER_DEFAULTS = {
+    "enabled": True,
+    "max_workers": 0,          # 0 なら CPU コア数 - 1（最低 1）
+    "min_bytes": 256 * 1024,   # これより小さい入力はプロセス間の受け渡しの方が高くつくのでその場で
+    "timeout": 120.0,          # 1 件の処理を待つ上限秒（超えたらその場で実行し直す）
+}
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+def _get_pool() -> Optional[ProcessPoolExecutor]:
+    global _pool
+    cfg = get_section("image_workers", IMAGE_WORKER_DEFAULTS)
+    if not cfg["enabled"]:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # スレッドの多い Streamlit から fork しないよう forkserver（無ければ spawn）
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            if ctx.get_start_method() == "forkserver":
+                ctx.set_forkserver_preload(["lib.image_ops"])
+            workers = cfg["max_workers"] or max(1, (os.cpu_count() or 2) - 1)
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+        return _pool
+
+def _discard_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def _take_outputs(name: Optional[str], lengths: List[int]) -> List[bytes]:
+    if name is None:
+        return [b"" for _ in lengths]
+    shm = image_ops.attach_shm(name)
+    try:
+        outs, pos = [], 0
+        for n in lengths:
+            outs.append(bytes(shm.buf[pos:pos + n]))
+            pos += n
+        return outs
+    finally:
+        shm.close()
+        shm.unlink()
+
+def _discard_late_output(future: Future) -> None:
+    """待つのをやめた処理が後から書いた出力の共有メモリを消す（受け取る者がいない）。"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    name = future.result()[0]
+    if name is not None:
+        shm = image_ops.attach_shm(name)
+        shm.close()
+        shm.unlink()
+
+def run_image_op(fn: Callable[..., Any], data: bytes, *args: Any) -> Any:
+    """fn(data, *args) をプロセスプールで実行して同じ戻り値を返す。
+
+    fn は lib.image_ops.OPS に登録された関数。プール無効・入力が小さい・プールが壊れた・
+    timeout 秒待っても終わらない（プールが混んでいる等）ときはこのスレッドでそのまま実行する（結果は同じ）。
+    """
+    cfg = get_section("image_workers", IMAGE_WORKER_DEFAULTS)
+    pool = _get_pool() if len(data) >= cfg["min_bytes"] else None
+    if pool is None or image_ops.OPS.get(fn.__name__) is not fn:
+        return fn(data, *args)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    try:
+        shm.buf[:len(data)] = data
+        future = pool.submit(image_ops.run_shm_op, fn.__name__, shm.name, len(data), args)
+        name, lengths, meta, packed = future.result(timeout=cfg["timeout"])
+    except BrokenProcessPool:  # 子プロセスが落ちた → 作り直しは次回、今回はその場で
+        _discard_pool()
+        return fn(data, *args)
+    except FutureTimeoutError:  # 待ちきれない → 取り消し（実行中なら出力は後で捨てる）、今回はその場で
+        if not future.cancel():
+            future.add_done_callback(_discard_late_output)
+        return fn(data, *args)
+    finally:
+        shm.close()
+        shm.unlink()
+    outs = _take_outputs(name, lengths)
+    return (outs, meta) if packed else outs[0]
+
+def worker_stats() -> dict:
+    with _pool_lock:
+        return {"running": _pool is not None,
+                "max_workers": getattr(_pool, "_max_workers", 0) if _pool is not None else 0}
@@ -0,0 +1,189 @@
+# lib/jobs.py
+from __future__ import annotations
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Optional
+
+import streamlit as st
+
+from lib.memory_budget import get_memory_budget
+from lib.settings import get_section
+
+# ジョブ実行プールの設定（secrets.toml の [jobs] で上書き可）
+JOB_DEFAULTS = {
+    "max_workers": 16,      # ジョブスレッド数（API の同時実行数は [rate_limit] 側で絞る）
+    "result_ttl": 900.0,    # 誰にも回収されなかった結果を保持する秒数
+}
+
+_local = threading.local()
+
+# メモリ台帳（lib/memory_budget.py）での名前。結果・プレビューの画像は回収されるまで数える（退避はしない）
+_BUDGET_OWNER = "jobs"
+
+class JobCancelled(Exception):
+    """ユーザーがジョブをキャンセルした。"""
+
+class JobLost(Exception):
+    """ジョブが見つからない（結果の保持期限切れ・サーバー再起動など）。"""
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    meta: Dict[str, Any] = field(default_factory=dict)
+    status: str = "queued"          # queued / running / done / error / cancelled
+    submitted_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Any = None
+    error: Optional[BaseException] = None
+    progress: str = ""              # 実行中の状況（順番待ちなど）をページに見せる
+    preview: Optional[bytes] = None  # 生成途中のプレビュー画像（ストリーミング時）
+    finished: threading.Event = field(default_factory=threading.Event, repr=False)
+    cancel_requested: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "error", "cancelled")
+
+    @property
+    def cancelled(self) -> bool:
+        return self.status == "cancelled"
+
+    def check_cancelled(self) -> None:
+        """キャンセル要求があれば JobCancelled を送出（待ちループの中から呼ぶ）。"""
+        if self.cancel_requested.is_set():
+            raise JobCancelled("キャンセルされました。")
+
+    def wait(self, timeout: float) -> bool:
+        return self.finished.wait(timeout)
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.time()) - self.submitted_at
+
+class JobManager:
+    """API 呼び出しをスクリプトスレッドから切り離して実行する有界スレッドプール。"""
+
+    def __init__(self, max_workers: int, result_ttl: float) -> None:
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-job")
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._result_ttl = result_ttl
+        self._budget = get_memory_budget()
+        self._budget.register(_BUDGET_OWNER, None)
+
+    def submit(self, kind: str, fn: Callable[..., Any], *args: Any,
+               meta: Optional[Dict[str, Any]] = None, **kwargs: Any) -> str:
+        self._prune()
+        job = Job(id=uuid.uuid4().hex, kind=kind, meta=dict(meta or {}))
+        with self._lock:
+            self._jobs[job.id] = job
+        self._pool.submit(self._run, job, fn, args, kwargs)
+        return job.id
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """キャンセルを要求する。実行中の HTTP 呼び出しは lib/openai_client 側で中断される。"""
+        job = self.get(job_id)
+        if job is None or job.done:
+            return False
+        job.cancel_requested.set()
+        return True
+
+    def forget(self, job_id: str) -> None:
+        with self._lock:
+            self._jobs.pop(job_id, None)
+        self._budget.release(_BUDGET_OWNER, (job_id, "result"))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            counts: Dict[str, int] = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return counts
+
+    def _run(self, job: Job, fn: Callable[..., Any], args: tuple, kwargs: dict) -> None:
+        job.started_at = time.time()
+        job.status = "running"
+        _local.job = job
+        try:
+            job.check_cancelled()  # 待ち行列にいる間にキャンセルされた
+            job.result = fn(*args, **kwargs)
+            data = getattr(job.result, "data", None)
+            if isinstance(data, bytes):
+                self._budget.charge(_BUDGET_OWNER, (job.id, "result"), len(data))
+            job.status = "done"
+        except JobCancelled as e:
+            job.error = e
+            job.status = "cancelled"
+        except BaseException as e:  # 例外はページ側で表示する
+            job.error = e
+            job.status = "error"
+        finally:
+            job.finished_at = time.time()
+            job.progress = ""
+            job.preview = None
+            self._budget.release(_BUDGET_OWNER, (job.id, "preview"))
+            _local.job = None
+            job.finished.set()
+
+    def _prune(self) -> None:
+        cutoff = time.time() - self._result_ttl
+        with self._lock:
+            stale = [k for k, j in self._jobs.items() if j.done and (j.finished_at or 0) < cutoff]
+            for k in stale:
+                del self._jobs[k]
+        for k in stale:
+            self._budget.release(_BUDGET_OWNER, (k, "result"))
+
+@st.cache_resource(show_spinner=False)
+def get_job_manager() -> JobManager:
+    cfg = get_section("jobs", JOB_DEFAULTS)
+    return JobManager(max_workers=cfg["max_workers"], result_ttl=cfg["result_ttl"])
+
+def submit_job(kind: str, fn: Callable[..., Any], *args: Any,
+               meta: Optional[Dict[str, Any]] = None, **kwargs: Any) -> str:
+    return get_job_manager().submit(kind, fn, *args, meta=meta, **kwargs)
+
+def get_job(job_id: str) -> Optional[Job]:
+    return get_job_manager().get(job_id)
+
+def forget_job(job_id: str) -> None:
+    get_job_manager().forget(job_id)
+
+def cancel_job(job_id: str) -> bool:
+    return get_job_manager().cancel(job_id)
+
+def current_job() -> Optional[Job]:
+    """ジョブスレッド内なら実行中の Job を返す。"""
+    return getattr(_local, "job", None)
+
+def set_job_progress(text: str, job: Optional[Job] = None) -> None:
+    """job 省略時は現在のジョブ（API ループのスレッドからは job を明示する）。"""
+    job = job or current_job()
+    if job is not None:
+        job.check_cancelled()  # 進捗を出す待ちループはキャンセルの確認点も兼ねる
+        job.progress = text
+
+def set_job_preview(image_bytes: bytes, job: Optional[Job] = None) -> None:
+    """job 省略時は現在のジョブ（API ループのスレッドからは job を明示する）。"""
+    job = job or current_job()
+    if job is not None:
+        job.preview = image_bytes
+        get_memory_budget().charge(_BUDGET_OWNER, (job.id, "preview"), len(image_bytes))
+
+def cancellable_sleep(seconds: float) -> None:
+    """ジョブスレッド内ならキャンセルで即座に起きる sleep。"""
+    job = current_job()
+    if job is None:
+        time.sleep(seconds)
+        return
+    if job.cancel_requested.wait(seconds):
+        job.check_cancelled()
@@ -0,0 +1,153 @@
+# lib/memory_budget.py
+# プロセス全体で画像バッファに使うメモリの上限と、その内訳の台帳。
+# 画像をメモリに持つキャッシュ（派生画像・ダウンロード用エンコードなど）は register() で名乗り、
+# 追加・参照・削除のたびに charge() / touch() / release() を呼ぶ。合計が上限を超えたら
+# 全キャッシュ横断で最も古く使われたものから、持ち主の spill(key) を呼んでディスクへ退避させる。
+# 退避したものは持ち主が次に参照されたときに読み戻し、note_reload() で数える。
+# 退避できない持ち主（実行中・回収待ちのジョブの画像など）は spill=None で登録し、合計には数えるが退避させない。
+# セッションの原寸画像は最初から lib/blob_store.py のファイルなので、ここでは数えない。
+from __future__ import annotations
+import hashlib
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from lib.settings import data_dir, get_section
+
+# secrets.toml の [memory_budget] で上書き可
+MEMORY_BUDGET_DEFAULTS = {
+    "max_bytes": 512_000_000,    # 登録されたキャッシュの合計（これを超えたら LRU で退避）
+}
+
+class MemoryBudget:
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._lru: "OrderedDict[Tuple[str, Hashable], int]" = OrderedDict()  # (持ち主, key) -> bytes（古い順）
+        self._total = 0
+        self._spillers: Dict[str, Optional[Callable[[Hashable], None]]] = {}
+        self._counters: Dict[str, Dict[str, int]] = {}
+        self._started = time.time()
+
+    def register(self, owner: str, spill: Optional[Callable[[Hashable], None]]) -> None:
+        """spill(key) は key をメモリから外してディスクへ移す（後で読み戻せるように）。None なら退避させない。"""
+        with self._lock:
+            self._spillers[owner] = spill
+            self._counters.setdefault(owner, {"bytes": 0, "entries": 0, "spills": 0, "spill_bytes": 0,
+                                              "reloads": 0, "reload_bytes": 0})
+
+    def charge(self, owner: str, key: Hashable, nbytes: int) -> None:
+        """owner が key を nbytes ぶんメモリに持った。上限を超えたら古いものから退避させる。"""
+        victims: List[Tuple[str, Hashable]] = []
+        with self._lock:
+            c = self._counters[owner]
+            old = self._lru.pop((owner, key), None)
+            if old is not None:
+                self._total -= old
+                c["bytes"] -= old
+                c["entries"] -= 1
+            self._lru[(owner, key)] = nbytes
+            self._total += nbytes
+            c["bytes"] += nbytes
+            c["entries"] += 1
+            over = self._total > self.max_bytes
+            for (v_owner, v_key), size in (list(self._lru.items()) if over else []):  # 古い順
+                if self._total <= self.max_bytes or (v_owner, v_key) == (owner, key):
+                    break
+                if self._spillers[v_owner] is None:  # 退避できない持ち主は飛ばす
+                    continue
+                del self._lru[(v_owner, v_key)]
+                self._total -= size
+                vc = self._counters[v_owner]
+                vc["bytes"] -= size
+                vc["entries"] -= 1
+                vc["spills"] += 1
+                vc["spill_bytes"] += size
+                victims.append((v_owner, v_key))
+            spillers = [self._spillers[o] for o, _k in victims]
+        for spill, (_o, v_key) in zip(spillers, victims):  # 書き出しはロックの外で
+            spill(v_key)
+
+    def touch(self, owner: str, key: Hashable) -> None:
+        with self._lock:
+            if (owner, key) in self._lru:
+                self._lru.move_to_end((owner, key))
+
+    def release(self, owner: str, key: Hashable) -> None:
+        """owner が自分の都合（件数上限など）で key を捨てた。"""
+        with self._lock:
+            size = self._lru.pop((owner, key), None)
+            if size is not None:
+                self._total -= size
+                self._counters[owner]["bytes"] -= size
+                self._counters[owner]["entries"] -= 1
+
+    def note_reload(self, owner: str, nbytes: int) -> None:
+        with self._lock:
+            self._counters[owner]["reloads"] += 1
+            self._counters[owner]["reload_bytes"] += nbytes
+
+    def stats(self) -> dict:
+        """合計と持ち主ごとの内訳（spills / reloads は起動からの累計、*_per_min はその平均）。"""
+        with self._lock:
+            minutes = max((time.time() - self._started) / 60.0, 1e-9)
+            owners = {}
+            for name, c in self._counters.items():
+                owners[name] = dict(c, spills_per_min=c["spills"] / minutes,
+                                    reloads_per_min=c["reloads"] / minutes)
+            return {"max_bytes": self.max_bytes, "bytes": self._total, "entries": len(self._lru),
+                    "owners": owners}
+
+_budget: Optional[MemoryBudget] = None
+_budget_lock = threading.Lock()
+
+def get_memory_budget() -> MemoryBudget:
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = MemoryBudget(get_section("memory_budget", MEMORY_BUDGET_DEFAULTS)["max_bytes"])
+            _remove_stale_spills()
+        return _budget
+
+# ---------------- 退避ファイル（data/spill/<pid>/<持ち主>/） ----------------
+def _spill_path(owner: str, key: Hashable) -> Path:
+    name = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+    return data_dir("spill") / str(os.getpid()) / owner / name
+
+def _remove_stale_spills() -> None:
+    """終了したプロセスの退避ファイルを消す（読み戻す者がいない）。"""
+    for path in data_dir("spill").iterdir():
+        if not path.name.isdigit() or int(path.name) == os.getpid():
+            continue
+        try:
+            os.kill(int(path.name), 0)
+            continue  # まだ動いている
+        except ProcessLookupError:
+            shutil.rmtree(path, ignore_errors=True)
+        except OSError:  # 権限なし＝別ユーザーのプロセスが動いている
+            continue
+
+def write_spill(owner: str, key: Hashable, data: bytes) -> None:
+    path = _spill_path(owner, key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+    tmp.write_bytes(data)
+    tmp.replace(path)
+
+def read_spill(owner: str, key: Hashable) -> Optional[bytes]:
+    """退避したものを読み戻す（読んだらファイルは消す）。無ければ None。"""
+    path = _spill_path(owner, key)
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return None
+    path.unlink(missing_ok=True)
+    get_memory_budget().note_reload(owner, len(data))
+    return data
+
+def discard_spill(owner: str, key: Hashable) -> None:
+    _spill_path(owner, key).unlink(missing_ok=True)
@@ -1,11 +1,153 @@
 # lib/openai_client.py
 from __future__ import annotations
-from openai import OpenAI
+import asyncio
+import concurrent.futures
+import threading
+from typing import Any, Awaitable, Dict, Optional, Tuple
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
 import streamlit as st
 
-def get_client() -> OpenAI:
-    api_key = st.secrets.get("OPENAI_API_KEY", "")
+from lib.jobs import Job, JobCancelled
+from lib.settings import get_secret, get_section
+
+# 接続プール設定（secrets.toml の [openai_http] で上書き可）
+HTTP_DEFAULTS = {
+    "max_connections": 20,             # 同時接続の上限（プロセス全体）
+    "max_keepalive_connections": 10,   # 使い回すために保持しておく接続数
+    "keepalive_expiry": 90.0,          # アイドル接続を保持する秒数
+    "connect_timeout": 10.0,
+    "read_timeout": 180.0,             # 画像生成は 30〜60 秒かかるので長め
+    "write_timeout": 60.0,
+    "pool_timeout": 30.0,              # プール空き待ちの上限
+    "http2": True,                     # h2 パッケージが無ければ自動で HTTP/1.1
+    "max_retries": 0,                  # 再試行は lib/retry.py で行う（二重リトライ防止）
+}
+
+# 操作ごとのタイムアウト（secrets.toml の [timeouts] で上書き可）
+# connect / read は 1 回の HTTP 呼び出し、total は 1 回の試行全体の上限秒
+TIMEOUT_DEFAULTS = {
+    "generate_connect": 10.0,
+    "generate_read": 180.0,
+    "generate_total": 240.0,
+    "edit_connect": 10.0,
+    "edit_read": 180.0,
+    "edit_total": 240.0,
+    "write": 60.0,
+    "pool": 30.0,
+}
+
+class RequestTimeout(TimeoutError):
+    """1 回の試行が total タイムアウトを超えた。"""
+
+def request_timeout(op: str) -> Tuple[httpx.Timeout, float]:
+    """op（generate / edit）の (httpx.Timeout, total 秒) を返す。"""
+    cfg = get_section("timeouts", TIMEOUT_DEFAULTS)
+    timeout = httpx.Timeout(
+        connect=cfg[f"{op}_connect"],
+        read=cfg[f"{op}_read"],
+        write=cfg["write"],
+        pool=cfg["pool"],
+    )
+    return timeout, cfg[f"{op}_total"]
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def _settings_key() -> Tuple[Tuple[str, object], ...]:
+    return tuple(sorted(get_section("openai_http", HTTP_DEFAULTS).items()))
+
+def _http_client_kwargs(cfg: Dict[str, Any]) -> Dict[str, Any]:
+    return dict(
+        limits=httpx.Limits(
+            max_connections=cfg["max_connections"],
+            max_keepalive_connections=cfg["max_keepalive_connections"],
+            keepalive_expiry=cfg["keepalive_expiry"],
+        ),
+        timeout=httpx.Timeout(
+            connect=cfg["connect_timeout"],
+            read=cfg["read_timeout"],
+            write=cfg["write_timeout"],
+            pool=cfg["pool_timeout"],
+        ),
+        http2=bool(cfg["http2"]) and _http2_available(),
+    )
+
+@st.cache_resource(show_spinner=False)
+def _shared_client(api_key: str, settings: Tuple[Tuple[str, object], ...],
+                   base_url: Optional[str] = None) -> OpenAI:
+    """プロセスで 1 つだけ作る OpenAI クライアント（keep-alive 接続プール付き）。"""
+    cfg = dict(settings)
+    http_client = DefaultHttpxClient(**_http_client_kwargs(cfg))
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client,
+                  max_retries=cfg["max_retries"])
+
+@st.cache_resource(show_spinner=False)
+def _shared_async_client(api_key: str, settings: Tuple[Tuple[str, object], ...],
+                         base_url: Optional[str] = None) -> AsyncOpenAI:
+    """画像 API 用の非同期クライアント。接続プールは API ループ（下記）専用。"""
+    cfg = dict(settings)
+    http_client = DefaultAsyncHttpxClient(**_http_client_kwargs(cfg))
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client,
+                       max_retries=cfg["max_retries"])
+
+def _api_key_and_base_url() -> Tuple[str, Optional[str]]:
+    api_key = get_secret("OPENAI_API_KEY", "")
     if not api_key:
         st.error("`.streamlit/secrets.toml` の OPENAI_API_KEY が見つかりません。")
         st.stop()
-    return OpenAI(api_key=api_key)
+    # OPENAI_BASE_URL: 負荷試験用のスタンドイン（lib/fake_images_server.py）などへ向ける
+    base_url = get_secret("OPENAI_BASE_URL", "") or None
+    return api_key, base_url
+
+def get_client() -> OpenAI:
+    api_key, base_url = _api_key_and_base_url()
+    return _shared_client(api_key, _settings_key(), base_url)
+
+def get_async_client() -> AsyncOpenAI:
+    """images.generate / images.edit 用（キャンセル可能）。呼び出しは run_on_api_loop で。"""
+    api_key, base_url = _api_key_and_base_url()
+    return _shared_async_client(api_key, _settings_key(), base_url)
+
+# ---------------- API ループ ----------------
+# 非同期クライアントの呼び出しは 1 本のイベントループスレッドにまとめる。
+# ジョブスレッドは結果を待つだけなので、キャンセル時はタスクを cancel して
+# 実行中の HTTP 接続をその場で切れる（同期クライアントでは中断できない）。
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+def _api_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="openai-api-loop", daemon=True).start()
+        return _loop
+
+def run_on_api_loop(coro: Awaitable[Any], *, total: Optional[float] = None,
+                    job: Optional[Job] = None) -> Any:
+    """coro を API ループで実行して結果を待つ。
+
+    job のキャンセル要求で実行中の呼び出しを中断して JobCancelled、
+    total 秒を超えたら RequestTimeout を送出する。
+    """
+    async def _guarded() -> Any:
+        return await asyncio.wait_for(coro, total)
+
+    fut = asyncio.run_coroutine_threadsafe(_guarded(), _api_loop())
+    while True:
+        done, _ = concurrent.futures.wait([fut], timeout=0.2)
+        if done:
+            break
+        if job is not None and job.cancel_requested.is_set():
+            fut.cancel()
+            raise JobCancelled("キャンセルされました。")
+    try:
+        return fut.result()
+    except asyncio.TimeoutError:
+        raise RequestTimeout(f"{total:g} 秒以内に応答がありませんでした。") from None
@@ -0,0 +1,274 @@
+# lib/prompt_search.py
+# JSONL ログ（logs/{app_name}.log.jsonl）に記録されたプロンプトの全文検索（SQLite FTS5）。
+# 索引は data/search/prompts.sqlite3。ログの読み終えた位置（バイトオフセット）を覚えておき、
+# sync() では追記された分だけを取り込む。pages/99 の削除などでファイルが置き換わったら作り直す。
+# トークナイザは trigram（分かち書きの無い日本語でも部分一致で引ける）。trigram は 2 文字以下の語を
+# 引けないので、1 文字ずつをトークンにした索引（prompt_chars）も持ち、短い語はその連続（フレーズ）で引く。
+# 取り込みは生成・修正のログを書いたページが request_prompt_sync() で背景スレッドに頼む（検索時の追いつきを小さく）。
+from __future__ import annotations
+import json
+import os
+import re
+import sqlite3
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+from lib.settings import APP_DIR, data_dir, get_section
+
+# secrets.toml の [prompt_search] で上書き可
+PROMPT_SEARCH_DEFAULTS = {
+    "enabled": True,
+    "log_file": "",              # 空なら APP_DIR/logs/{app_name}.log.jsonl（共通ロガーの出力先）
+    "page_size": 20,
+    "batch_lines": 5000,         # 取り込み時に 1 トランザクションで入れる行数
+    "scan_rows": 50000,          # 索引で引けない語（記号だけの語）は新しい方からこの行数だけ走査する
+    "snippet_chars": 80,         # 抜粋の長さ
+}
+
+_SCHEMA_VERSION = 2              # 変わったら索引を作り直す（PRAGMA user_version）
+
+_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS prompts USING fts5(
+    prompt,
+    user UNINDEXED,
+    ts UNINDEXED,
+    action UNINDEXED,
+    model UNINDEXED,
+    size UNINDEXED,
+    blob UNINDEXED,
+    tokenize = 'trigram'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS prompt_chars USING fts5(
+    chars,
+    content = '',
+    tokenize = 'unicode61 remove_diacritics 0'
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    id     INTEGER PRIMARY KEY CHECK (id = 1),
+    inode  INTEGER NOT NULL,
+    offset INTEGER NOT NULL
+);
+"""
+
+_ACTIONS = ("generate", "edit")
+
+@dataclass(frozen=True)
+class PromptHit:
+    rowid: int
+    user: str
+    ts: str
+    action: str
+    model: str
+    size: str
+    blob: str                    # 画像の sha256（古いログには無い）
+    snippet: str                 # 一致箇所を ** で囲んだ抜粋（Markdown の記号はエスケープ済み）
+
+def _fts_query(terms: List[str]) -> Optional[str]:
+    """3 文字以上の語をすべて含む（AND）FTS5 クエリ（trigram は 3 文字未満の語を引けない）。"""
+    long_terms = [t for t in terms if len(t) >= 3]
+    if not long_terms:
+        return None
+    return " AND ".join('"' + t.replace('"', '""') + '"' for t in long_terms)
+
+def _chars(text: str) -> List[str]:
+    """prompt_chars のトークン（英数字・かな・漢字を 1 文字ずつ。記号と空白は unicode61 が区切りとして捨てる）。"""
+    return [c for c in text if c.isalnum()]
+
+def _char_query(terms: List[str]) -> Optional[str]:
+    """2 文字以下の語を 1 文字トークンの連続（フレーズ）として AND でつないだ prompt_chars 用クエリ。"""
+    phrases = ['"' + " ".join(_chars(t)) + '"' for t in terms if len(t) < 3 and _chars(t)]
+    return " AND ".join(phrases) if phrases else None
+
+_MD_SPECIAL = re.compile(r"([\\`*_{}\[\]()#+\-.!|<>~$&:])")
+
+def _escape_md(text: str) -> str:
+    """Markdown（と Streamlit の :色[...] / $数式$）として解釈される記号をバックスラッシュでエスケープする。"""
+    return _MD_SPECIAL.sub(r"\\\1", text)
+
+def _snippet(prompt: str, terms: List[str], width: int) -> str:
+    """最初の一致のまわり width 文字の抜粋。一致箇所を ** で囲み、それ以外は Markdown をエスケープする。"""
+    prompt = " ".join(prompt.split())
+    pattern = re.compile("|".join(re.escape(t) for t in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    first = pattern.search(prompt)
+    start = max(0, (first.start() if first else 0) - width // 4)
+    end = min(len(prompt), start + width)
+    window = prompt[start:end]
+    out, pos = [], 0
+    for m in pattern.finditer(window):
+        out.append(_escape_md(window[pos:m.start()]))
+        out.append("**" + _escape_md(m.group()) + "**")
+        pos = m.end()
+    out.append(_escape_md(window[pos:]))
+    return ("…" if start > 0 else "") + "".join(out) + ("…" if end < len(prompt) else "")
+
+class PromptIndex:
+    def __init__(self, db_path: Path, log_file: Path, batch_lines: int, scan_rows: int = 50000,
+                 snippet_chars: int = 80) -> None:
+        self.log_file = log_file
+        self.batch_lines = batch_lines
+        self.scan_rows = scan_rows
+        self.snippet_chars = snippet_chars
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] != _SCHEMA_VERSION:
+            self._reset()  # 古い形式の索引はログから作り直す
+        self._conn.executescript(_SCHEMA)
+        self._wake = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()  # sync() 中の _lock を待たないよう別のロック
+
+    def _reset(self) -> None:
+        self._conn.executescript("DROP TABLE IF EXISTS prompts; DROP TABLE IF EXISTS prompt_chars;"
+                                 " DROP TABLE IF EXISTS sync_state;" + _SCHEMA
+                                 + f"PRAGMA user_version = {_SCHEMA_VERSION};")
+
+    def _state(self) -> tuple:
+        row = self._conn.execute("SELECT inode, offset FROM sync_state WHERE id = 1").fetchone()
+        return row if row else (0, 0)
+
+    def sync(self) -> int:
+        """ログに追記された分を取り込み、取り込んだ件数を返す。"""
+        with self._lock:
+            try:
+                st_ = os.stat(self.log_file)
+            except FileNotFoundError:
+                return 0
+            inode, offset = self._state()
+            if st_.st_ino != inode or st_.st_size < offset:  # 置き換え・切り詰め → 作り直し
+                self._reset()
+                offset = 0
+            if st_.st_size == offset:
+                self._save_state(st_.st_ino, offset)
+                return 0
+            added = 0
+            with open(self.log_file, "rb") as f:
+                f.seek(offset)
+                while True:
+                    lines = f.readlines(self.batch_lines * 512)
+                    if not lines:
+                        break
+                    if not lines[-1].endswith(b"\n"):  # 書きかけの行は次回に回す
+                        lines.pop()
+                        if not lines:
+                            break
+                    rows = [r for r in map(self._row, lines) if r is not None]
+                    offset += sum(len(line) for line in lines)
+                    self._conn.execute("BEGIN")
+                    for row in rows:
+                        cur = self._conn.execute(
+                            "INSERT INTO prompts (prompt, user, ts, action, model, size, blob)"
+                            " VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+                        self._conn.execute("INSERT INTO prompt_chars (rowid, chars) VALUES (?, ?)",
+                                           (cur.lastrowid, " ".join(_chars(row[0]))))
+                    self._save_state(st_.st_ino, offset)
+                    self._conn.execute("COMMIT")
+                    added += len(rows)
+            return added
+
+    def request_sync(self) -> None:
+        """背景スレッドに取り込みを頼む（ログを書いた直後に呼ぶ。呼んだ側は待たない）。"""
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._sync_loop, name="prompt-search-sync", daemon=True)
+                self._worker.start()
+        self._wake.set()
+
+    def _sync_loop(self) -> None:
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                self.sync()
+            except Exception:  # 壊れた行などで止めない（次の依頼・検索時の sync() でやり直す）
+                pass
+
+    def _save_state(self, inode: int, offset: int) -> None:
+        self._conn.execute("INSERT OR REPLACE INTO sync_state (id, inode, offset) VALUES (1, ?, ?)",
+                           (inode, offset))
+
+    @staticmethod
+    def _row(line: bytes) -> Optional[tuple]:
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            return None
+        prompt = rec.get("prompt") if isinstance(rec, dict) else None
+        if not prompt or rec.get("action") not in _ACTIONS:
+            return None
+        return (prompt, rec.get("user") or "(anonymous)", rec.get("ts") or "", rec["action"],
+                rec.get("model") or "", rec.get("size") or "", rec.get("blob") or "")
+
+    def search(self, text: str, *, user: Optional[str] = None, limit: int = 20,
+               before: Optional[int] = None) -> List[PromptHit]:
+        """text を含むプロンプトを新しい順に limit 件。user を渡すとその人の分だけ。
+
+        before（前ページ最後の rowid）でページ送りする。3 文字以上の語があれば trigram 索引で、
+        2 文字以下の語だけなら 1 文字索引のフレーズで、新しい順に引きながら絞る（limit 件で止まる）。
+        短い語は引いた行に LIKE をかけて確かめる。記号だけの語しか無いときは索引を使えないので、
+        新しい方から scan_rows 行だけを走査する。
+        """
+        terms = text.split()
+        if not terms:
+            return []
+        query = _fts_query(terms)
+        char_query = _char_query(terms) if query is None else None
+        where: List[str] = []
+        params: list = []
+        if query is not None:
+            source = "prompts p"
+            where.append("prompts MATCH ?")
+            params.append(query)
+        elif char_query is not None:
+            source = "prompt_chars c CROSS JOIN prompts p ON p.rowid = c.rowid"  # 1 文字索引を外側に
+            where.append("prompt_chars MATCH ?")
+            params.append(char_query)
+        else:
+            source = "prompts p"
+            where.append("p.rowid > (SELECT max(rowid) FROM prompts) - ?")
+            params.append(self.scan_rows)
+        order = "c.rowid" if char_query is not None else "p.rowid"
+        for t in terms:
+            if len(t) < 3:
+                where.append("p.prompt LIKE ? ESCAPE '\\'")
+                params.append("%" + t.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        if user is not None:
+            where.append("p.user = ?")
+            params.append(user)
+        if before is not None:
+            where.append(f"{order} < ?")
+            params.append(before)
+        sql = (f"SELECT p.rowid, p.user, p.ts, p.action, p.model, p.size, p.blob, p.prompt FROM {source}"
+               f" WHERE {' AND '.join(where)} ORDER BY {order} DESC LIMIT ?")
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [PromptHit(*row[:7], _snippet(row[7], terms, self.snippet_chars)) for row in rows]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM prompts").fetchone()[0]
+
+_index: Optional[PromptIndex] = None
+_index_lock = threading.Lock()
+
+def get_prompt_index() -> Optional[PromptIndex]:
+    """[prompt_search] enabled=false なら None。"""
+    global _index
+    cfg = get_section("prompt_search", PROMPT_SEARCH_DEFAULTS)
+    if not cfg["enabled"]:
+        return None
+    with _index_lock:
+        if _index is None:
+            log_file = Path(cfg["log_file"]) if cfg["log_file"] else APP_DIR / "logs" / f"{APP_DIR.name}.log.jsonl"
+            _index = PromptIndex(data_dir("search") / "prompts.sqlite3", log_file, cfg["batch_lines"],
+                                 cfg["scan_rows"], cfg["snippet_chars"])
+        return _index
+
+def request_prompt_sync() -> None:
+    """生成・修正のログを書いたページから呼ぶ。検索が無効なら何もしない。"""
+    index = get_prompt_index()
+    if index is not None:
+        index.request_sync()
@@ -0,0 +1,220 @@
+# lib/rate_limit.py
+# Images API の呼び出し流量を抑える（RPM トークンバケット＋同時実行数＋ユーザー別上限）。
+# ジョブスレッドから使うので st.* は使わない。
+from __future__ import annotations
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from lib.settings import APP_DIR, get_section
+
+# secrets.toml の [rate_limit] で上書き可
+RATE_LIMIT_DEFAULTS = {
+    "rpm": 50.0,                # 1 分あたりの呼び出し数（OpenAI 側の上限より少し下に）
+    "burst": 5,                 # バケット容量（瞬間的に許す連続呼び出し数）
+    "max_in_flight": 8,         # 同時に API を叩く数（プロセス全体）
+    "per_user": 4,              # 1 ユーザーの同時実行数（複数枚生成の 4 並列が通る値）
+    "wait_timeout": 600.0,      # 順番待ちの上限秒数
+    "shared_state_file": "",    # 指定すると RPM バケットを複数プロセスで共有（fcntl 必須）
+}
+
+WaitCallback = Callable[[int, float], None]  # (待ち順位, 推定待ち秒)
+
+class RateLimitTimeout(TimeoutError):
+    """順番待ちが wait_timeout を超えた。"""
+
+class _TokenBucket:
+    def __init__(self, rate_per_sec: float, capacity: int) -> None:
+        self.rate = rate_per_sec
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._ts = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+        self._ts = now
+
+    def take(self) -> float:
+        """1 トークン取得できれば 0、できなければ次のトークンまでの秒数を返す。"""
+        self._refill()
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return 0.0
+        return (1.0 - self._tokens) / self.rate
+
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+class _FileTokenBucket(_TokenBucket):
+    """状態をファイルに置き、flock で排他して複数プロセスで共有するバケット。"""
+
+    def __init__(self, rate_per_sec: float, capacity: int, path: Path) -> None:
+        super().__init__(rate_per_sec, capacity)
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.touch(exist_ok=True)
+
+    def _locked(self, fn: Callable[[], float]) -> float:
+        import fcntl
+        with self.path.open("r+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                try:
+                    state = json.loads(f.read() or "{}")
+                except ValueError:
+                    state = {}
+                now = time.time()
+                tokens = float(state.get("tokens", self.capacity))
+                ts = float(state.get("ts", now))
+                self._tokens = min(self.capacity, tokens + max(0.0, now - ts) * self.rate)
+                self._ts = time.monotonic()
+                out = fn()
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps({"tokens": self._tokens, "ts": now}))
+                return out
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def take(self) -> float:
+        return self._locked(super().take)
+
+    def tokens(self) -> float:
+        return self._locked(super().tokens)
+
+class RateLimiter:
+    """FIFO の順番待ち付きリミッタ。
+
+    先頭から順に、同時実行数・ユーザー別上限・トークンがそろった時点で通す。
+    ユーザー別上限で止まっている待ち行列は、他ユーザーの追い越しを妨げない。
+    """
+
+    def __init__(self, rpm: float, burst: int, max_in_flight: int, per_user: int,
+                 wait_timeout: float, shared_state_file: str = "") -> None:
+        rate = max(rpm, 0.001) / 60.0
+        burst = max(int(burst), 1)
+        if shared_state_file:
+            path = Path(shared_state_file)
+            if not path.is_absolute():
+                path = APP_DIR / path
+            self._bucket: _TokenBucket = _FileTokenBucket(rate, burst, path)
+        else:
+            self._bucket = _TokenBucket(rate, burst)
+        self.max_in_flight = max(int(max_in_flight), 1)
+        self.per_user = max(int(per_user), 1)
+        self.wait_timeout = wait_timeout
+        self._cond = threading.Condition()
+        self._queue: List[List[str]] = []     # [user] の待ち札の FIFO
+        self._in_flight = 0
+        self._user_in_flight: Dict[str, int] = {}
+        self._user_started: Dict[str, List[float]] = {}  # user -> 実行中の呼び出しの開始時刻（古い順）
+        self._avg_duration = 40.0             # 1 呼び出しの所要秒数（指数移動平均）
+
+    # ---------------- 内部 ----------------
+    def _user_ok(self, user: str) -> bool:
+        return self._user_in_flight.get(user, 0) < self.per_user
+
+    def _ahead(self, entry: List[str]) -> int:
+        n = 0
+        for other in self._queue:
+            if other is entry:
+                break
+            if self._user_ok(other[0]):
+                n += 1
+        return n
+
+    def _own_wait(self, user: str) -> Tuple[int, float]:
+        """ユーザー別上限で止まっているとき、(空くのを待つ自分の呼び出し数, それが空くまでの推定秒)。"""
+        over = self._user_in_flight.get(user, 0) - self.per_user + 1
+        if over <= 0:
+            return 0, 0.0
+        now = time.monotonic()
+        # 平均所要時間から残りを見積もる（平均を超えて走っているものは、あと平均 1 回分とみなす）
+        left = sorted(self._avg_duration - (now - t) if now - t < self._avg_duration else self._avg_duration
+                      for t in self._user_started.get(user, []))
+        return over, (left[over - 1] if len(left) >= over else self._avg_duration)
+
+    def _estimate(self, position: int) -> float:
+        free = self.max_in_flight - self._in_flight
+        slot_wait = 0.0
+        if position > free:
+            slot_wait = math.ceil((position - free) / self.max_in_flight) * self._avg_duration
+        token_wait = max(0.0, position - self._bucket.tokens()) / self._bucket.rate
+        return max(slot_wait, token_wait)
+
+    # ---------------- 公開 API ----------------
+    def acquire(self, user: str, on_wait: Optional[WaitCallback] = None) -> None:
+        entry = [user]  # 同一性で識別する待ち札
+        deadline = time.monotonic() + self.wait_timeout
+        with self._cond:
+            self._queue.append(entry)
+            try:
+                while True:
+                    ahead = self._ahead(entry)
+                    delay = 1.0
+                    if ahead == 0 and self._in_flight < self.max_in_flight and self._user_ok(user):
+                        token_wait = self._bucket.take()
+                        if token_wait == 0.0:
+                            break
+                        delay = min(delay, token_wait)
+                    if on_wait is not None:
+                        own, own_wait = self._own_wait(user)  # 自分の実行中の呼び出しも前にいる
+                        on_wait(ahead + own + 1, own_wait + self._estimate(ahead + 1))
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise RateLimitTimeout("混雑のため順番待ちがタイムアウトしました。しばらくしてから再実行してください。")
+                    self._cond.wait(min(delay, remaining))
+                self._in_flight += 1
+                self._user_in_flight[user] = self._user_in_flight.get(user, 0) + 1
+                self._user_started.setdefault(user, []).append(time.monotonic())
+            finally:
+                self._queue.remove(entry)
+                self._cond.notify_all()
+
+    def release(self, user: str, duration: Optional[float] = None) -> None:
+        with self._cond:
+            self._in_flight = max(0, self._in_flight - 1)
+            left = self._user_in_flight.get(user, 1) - 1
+            if left > 0:
+                self._user_in_flight[user] = left
+                del self._user_started[user][0]
+            else:
+                self._user_in_flight.pop(user, None)
+                self._user_started.pop(user, None)
+            if duration is not None:
+                self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, user: str, on_wait: Optional[WaitCallback] = None) -> Iterator[None]:
+        self.acquire(user, on_wait)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(user, time.monotonic() - started)
+
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            return {
+                "in_flight": self._in_flight,
+                "waiting": len(self._queue),
+                "avg_duration": round(self._avg_duration, 1),
+            }
+
+_limiter: Optional[RateLimiter] = None
+_limiter_lock = threading.Lock()
+
+def get_rate_limiter() -> RateLimiter:
+    """プロセス共通のリミッタ（ジョブスレッドからも呼べるよう st.cache_resource は使わない）。"""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter(**get_section("rate_limit", RATE_LIMIT_DEFAULTS))
+        return _limiter
@@ -0,0 +1,134 @@
+# lib/result_cache.py
+# 生成／修正結果のディスクキャッシュ（内容アドレス＋容量上限つき LRU）。
+# 画像は API が返した形式のまま保存する（拡張子 .png / .webp / .jpg）。
+# デモや研修で同じプロンプトを繰り返すときの課金と待ち時間を省く（既定は無効）。
+from __future__ import annotations
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from lib.image_utils import image_ext
+from lib.settings import data_dir, get_section
+
+# secrets.toml の [result_cache] で上書き可
+RESULT_CACHE_DEFAULTS = {
+    "enabled": False,            # オプトイン（有効時のみページにトグルを出す）
+    "max_bytes": 2_000_000_000,  # ディスク使用量の上限（超えたら古い順に削除）
+}
+
+def normalize_prompt(prompt: str) -> str:
+    """全角半角・連続空白の違いでキャッシュが外れないように正規化する。"""
+    return " ".join(unicodedata.normalize("NFKC", prompt).split())
+
+def cache_key(action: str, model: str, prompt: str, size: str, src_hash: str = "",
+              variant: int = 0, fmt: str = "") -> str:
+    """variant は複数枚生成の何枚目か、fmt は PNG 以外の出力形式（どちらも既定なら従来どおりのキー）。"""
+    parts = [action, model, normalize_prompt(prompt), size, src_hash]
+    if variant:
+        parts.append(variant)
+    if fmt:
+        parts.append(fmt)
+    raw = json.dumps(parts, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+_EXTS = ("png", "webp", "jpg")
+
+class ResultCache:
+    def __init__(self, root: Path, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # key -> bytes（古い順）
+        self._total = 0
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _path(self, key: str, ext: str) -> Path:
+        return self.root / key[:2] / f"{key}.{ext}"
+
+    def _find(self, key: str) -> Optional[Path]:
+        for ext in _EXTS:
+            path = self._path(key, ext)
+            if path.exists():
+                return path
+        return None
+
+    def _load(self) -> None:
+        files = []
+        for p in self.root.glob("*/*.*"):
+            if p.suffix.lstrip(".") not in _EXTS:
+                continue
+            try:
+                info = p.stat()
+            except FileNotFoundError:
+                continue
+            files.append((info.st_mtime, p.stem, info.st_size))
+        for _mtime, key, size in sorted(files):
+            self._entries[key] = size
+            self._total += size
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            path = self._find(key)
+            try:
+                if path is None:
+                    raise FileNotFoundError(key)
+                data = path.read_bytes()
+                os.utime(path)  # mtime を LRU の順序として使う（再起動後も保つ）
+            except FileNotFoundError:  # 未登録、または他プロセスが削除済み
+                self._total -= self._entries.pop(key, 0)
+                self.misses += 1
+                return None
+            if key not in self._entries:  # 他プロセスが書いたもの
+                self._entries[key] = len(data)
+                self._total += len(data)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key, image_ext(data))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        tmp.replace(path)
+        with self._lock:
+            self._total -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._total += len(data)
+            while self._total > self.max_bytes and self._entries:
+                old_key, old_size = self._entries.popitem(last=False)
+                self._total -= old_size
+                old_path = self._find(old_key)
+                if old_path is not None:
+                    old_path.unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._total,
+                    "hits": self.hits, "misses": self.misses}
+
+_cache: Optional[ResultCache] = None
+_cache_lock = threading.Lock()
+
+def result_cache_enabled() -> bool:
+    return bool(get_section("result_cache", RESULT_CACHE_DEFAULTS)["enabled"])
+
+def get_result_cache() -> Optional[ResultCache]:
+    """有効ならプロセス共通のキャッシュを返す（ジョブスレッドからも呼べる）。"""
+    global _cache
+    cfg = get_section("result_cache", RESULT_CACHE_DEFAULTS)
+    if not cfg["enabled"]:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache(data_dir("result_cache"), cfg["max_bytes"])
+        return _cache
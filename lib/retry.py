@@ -0,0 +1,110 @@
+# lib/retry.py
+# 一時的なエラー（429 / 5xx / 接続断）をジッター付き指数バックオフで再試行する。
+# ジョブスレッドから使うので st.* は使わない。
+from __future__ import annotations
+import email.utils
+import random
+import time
+from typing import Callable, Optional, Tuple, TypeVar
+
+import openai
+
+from lib.settings import get_section
+
+# secrets.toml の [retry] で上書き可
+RETRY_DEFAULTS = {
+    "max_attempts": 4,      # 初回を含む試行回数
+    "base_delay": 1.0,      # 1 回目の待ちの上限秒（以降 2 倍ずつ）
+    "max_delay": 20.0,      # 1 回の待ちの上限秒
+    "budget": 240.0,        # 初回開始からの合計時間の上限秒
+}
+
+# SDK と同じ基準：408 / 409 / 429 / 5xx は再試行
+RETRYABLE_STATUS = {408, 409, 429}
+
+# 429 でも待っても解消しないもの
+FATAL_CODES = {"insufficient_quota", "billing_hard_limit_reached"}
+
+T = TypeVar("T")
+RetryCallback = Callable[[int, float, BaseException], None]  # (再試行回数, 待ち秒, 例外)
+
+def _error_code(exc: BaseException) -> str:
+    code = getattr(exc, "code", None)
+    if code:
+        return str(code)
+    body = getattr(exc, "body", None)
+    if isinstance(body, dict):
+        err = body.get("error", body)
+        if isinstance(err, dict) and err.get("code"):
+            return str(err["code"])
+    return ""
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, openai.APIConnectionError):  # APITimeoutError を含む
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        if _error_code(exc) in FATAL_CODES:
+            return False
+        return exc.status_code in RETRYABLE_STATUS or exc.status_code >= 500
+    return False
+
+def retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """Retry-After / retry-after-ms ヘッダがあれば秒で返す。"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    ms = headers.get("retry-after-ms")
+    if ms:
+        try:
+            return float(ms) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+def describe_error(exc: BaseException) -> str:
+    """ページに出す日本語メッセージ（再試行しても直らない代表例を言い換える）。"""
+    code = _error_code(exc)
+    text = str(exc)
+    if code in ("moderation_blocked", "content_policy_violation") or "safety system" in text:
+        return "コンテンツポリシーにより拒否されました。プロンプトや画像の内容を見直してください。"
+    if "must be verified" in text:
+        return "組織の認証（Verify Organization）が必要なモデルです。管理者に連絡してください。"
+    if code in FATAL_CODES:
+        return "API の利用枠を超えています。管理者に連絡してください。"
+    if isinstance(exc, openai.APIConnectionError):
+        return f"OpenAI に接続できませんでした（再試行済み）: {text}"
+    return text
+
+def call_with_retry(fn: Callable[[], T], *, on_retry: Optional[RetryCallback] = None,
+                    sleep: Callable[[float], None] = time.sleep) -> Tuple[T, int]:
+    """fn() を再試行付きで呼ぶ。戻り値は (結果, 再試行回数)。"""
+    cfg = get_section("retry", RETRY_DEFAULTS)
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        try:
+            return fn(), attempt
+        except Exception as e:
+            attempt += 1
+            if not is_retryable(e) or attempt >= cfg["max_attempts"]:
+                raise
+            backoff = random.uniform(0.0, min(cfg["max_delay"], cfg["base_delay"] * 2 ** (attempt - 1)))
+            hinted = retry_after_seconds(e)
+            delay = max(backoff, hinted) if hinted is not None else backoff
+            if time.monotonic() - started + delay > cfg["budget"]:
+                raise
+            if on_retry is not None:
+                on_retry(attempt, delay, e)
+            sleep(delay)
@@ -1,7 +1,11 @@
 # lib/session_bridge.py
 from __future__ import annotations
+from typing import Optional
+
 import streamlit as st
 
+from lib.blob_store import put_blob, read_blob
+
 EDIT_PAGE_PATH = "pages/02_画像修正.py"
 
 def consume_goto_hook() -> None:
@@ -15,16 +19,26 @@ def consume_goto_hook() -> None:
             st.page_link(EDIT_PAGE_PATH, label="➡ 02_画像修正へ移動", width="content")
 
 def send_image_bytes_and_go(png_bytes: bytes, *, size: str, model: str, prompt: str) -> None:
-    """画像PNGバイトとメタをセッションへ保存 → rerun → consume_goto_hook で02へ。"""
-    st.session_state["edit_src_bytes"] = png_bytes
+    """画像PNGとメタをセッションへ保存 → rerun → consume_goto_hook で02へ。
+
+    画像そのものはブロブストアに置き、セッションにはハンドルだけを持つ（get_edit_src_bytes で読む）。
+    """
+    st.session_state["edit_src_blob"] = put_blob(png_bytes)
     st.session_state["edit_src_size"] = size
     st.session_state["edit_src_model"] = model
     st.session_state["edit_src_prompt"] = prompt
     st.session_state["_goto_edit_page"] = True
     st.rerun()
 
+def get_edit_src_bytes() -> Optional[bytes]:
+    """send_image_bytes_and_go で渡された画像（無ければ None）。"""
+    ref = st.session_state.get("edit_src_blob")
+    if ref is not None:
+        return read_blob(ref)
+    return st.session_state.get("edit_src_bytes")  # 旧形式（バイト列を直接置いていた頃）
+
 def clear_edit_payload() -> None:
-    for k in ["edit_src_bytes", "edit_src_kind", "edit_src_data",
+    for k in ["edit_src_blob", "edit_src_bytes", "edit_src_kind", "edit_src_data",
               "edit_src_size", "edit_src_model", "edit_src_prompt"]:
         if k in st.session_state:
             del st.session_state[k]
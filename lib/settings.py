@@ -0,0 +1,44 @@
+# lib/settings.py
+from __future__ import annotations
+from pathlib import Path
+from typing import Any, Dict
+
+import streamlit as st
+
+APP_DIR = Path(__file__).resolve().parents[1]
+
+def get_secret(name: str, default: Any = None) -> Any:
+    """st.secrets.get の安全版（secrets.toml が無くても default を返す）。"""
+    try:
+        return st.secrets.get(name, default)
+    except FileNotFoundError:
+        return default
+
+def get_section(name: str, defaults: Dict[str, Any]) -> Dict[str, Any]:
+    """secrets.toml の [name] セクションを defaults に上書きマージして返す。
+
+    未知のキーは無視し、値は defaults 側の型に合わせて変換する。
+    """
+    merged = dict(defaults)
+    section = get_secret(name, {}) or {}
+    for key, base in defaults.items():
+        if key not in section:
+            continue
+        value = section[key]
+        if isinstance(base, bool) and isinstance(value, str):
+            merged[key] = value.strip().lower() in ("1", "true", "yes", "on")
+            continue
+        try:
+            merged[key] = type(base)(value) if base is not None else value
+        except (TypeError, ValueError):
+            pass
+    return merged
+
+def data_dir(name: str) -> Path:
+    """アプリのデータ置き場（既定 APP_DIR/data、secrets の DATA_DIR で変更可）配下のディレクトリ。"""
+    base = Path(get_secret("DATA_DIR", "") or APP_DIR / "data")
+    if not base.is_absolute():
+        base = APP_DIR / base
+    path = base / name
+    path.mkdir(parents=True, exist_ok=True)
+    return path
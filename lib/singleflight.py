@@ -0,0 +1,61 @@
+# lib/singleflight.py
+# 同じキーの処理が実行中なら、新たに実行せずその結果を待って共有する。
+from __future__ import annotations
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+class _Call:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.followers = 0
+
+class SingleFlight:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any],
+           on_join: Optional[Callable[[], None]] = None,
+           wait_check: Optional[Callable[[], None]] = None) -> Tuple[Any, bool]:
+        """fn() を実行して (結果, 相乗りしたか) を返す。
+
+        同じ key が実行中なら fn() は呼ばず、先行呼び出しの結果（例外も含む）を受け取る。
+        待っている間は wait_check() を定期的に呼ぶ（例外を投げれば待ちをやめる）。
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.followers += 1
+        if not leader:
+            if on_join is not None:
+                on_join()
+            while not call.done.wait(0.5):
+                if wait_check is not None:
+                    wait_check()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+_flight = SingleFlight()
+
+def get_singleflight() -> SingleFlight:
+    return _flight
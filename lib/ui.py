@@ -1,32 +1,261 @@
 # lib/ui.py
 from __future__ import annotations
+import sqlite3
 from io import BytesIO
+from typing import Dict, List, Optional
 from PIL import Image
 import streamlit as st
 
+from lib.blob_store import BlobRef, put_blob
+from lib.derivatives import (DOWNLOAD_FORMATS, available_download_formats, encode_for_download,
+                             get_derivatives)
+from lib.edit_history import EditHistory, get_history
+from lib.gallery import get_gallery
+from lib.image_api import OUTPUT_DEFAULTS
+from lib.image_hash import IMAGE_HASH_DEFAULTS
+from lib.image_utils import IMAGE_FORMATS, sniff_format
+from lib.jobs import Job, JobLost, cancel_job, get_job, forget_job
+from lib.result_cache import result_cache_enabled
+from lib.settings import get_section
+
 def show_image(img_or_url, *, caption: str | None = None, width: str = "stretch") -> None:
     """st.image の薄いラッパ（width='stretch' / 'content'）。"""
     st.image(img_or_url, caption=caption, width=width)
 
+def show_preview(image: bytes | BlobRef, *, caption: str | None = None, width: str = "stretch") -> None:
+    """原寸の代わりに表示用プレビュー（縮小 WebP/JPEG）を出す。原寸はダウンロードで渡す。"""
+    st.image(get_derivatives(image).preview, caption=caption, width=width)
+
+def show_thumbnail(image: bytes | BlobRef, *, caption: str | None = None) -> None:
+    st.image(get_derivatives(image).thumb, caption=caption)
+
+def _as_bytes(image: bytes | BlobRef) -> bytes:
+    return image.read() if isinstance(image, BlobRef) else image
+
 def download_img_buttons(img: Image.Image, basename: str) -> None:
-    """PNG/WEBP のDLボタン（幅APIを width= に置換）。"""
-    # PNG
-    png_buf = BytesIO()
-    img.save(png_buf, format="PNG")
+    """PNG/WEBP のDLボタン（押されたときだけエンコードする）。"""
+    def encode(fmt: str):
+        def run() -> bytes:
+            buf = BytesIO()
+            img.save(buf, format=fmt)
+            return buf.getvalue()
+        return run
+
     st.download_button(
         "PNGでダウンロード",
-        data=png_buf.getvalue(),
+        data=encode("PNG"),
         file_name=f"{basename}.png",
         mime="image/png",
         width="stretch",
     )
-    # WEBP
-    webp_buf = BytesIO()
-    img.save(webp_buf, format="WEBP")
     st.download_button(
         "WEBPでダウンロード",
-        data=webp_buf.getvalue(),
+        data=encode("WEBP"),
         file_name=f"{basename}.webp",
         mime="image/webp",
         width="stretch",
     )
+
+def other_format_downloads(image: bytes | BlobRef, basename: str, *, src_fmt: str = "",
+                           quality: int = 90) -> None:
+    """別形式（最適化 PNG / WebP / JPEG / AVIF）で保存するボタン。
+
+    エンコードはボタンが押されたときに別スレッドで行い、結果は内容ハッシュ・形式・品質で使い回す。
+    """
+    src_fmt = src_fmt or (sniff_format(image) if isinstance(image, bytes) else "")
+    formats = [f for f in available_download_formats() if f != src_fmt or f == "png"]
+    for col, fmt in zip(st.columns(len(formats)), formats):
+        _pil, mime, ext, _lossy = DOWNLOAD_FORMATS[fmt]
+        label = "PNG（最適化）" if fmt == "png" else fmt.upper()
+        with col:
+            st.download_button(
+                label,
+                data=lambda fmt=fmt: encode_for_download(_as_bytes(image), fmt, quality),
+                file_name=f"{basename}.{ext}",
+                mime=mime,
+                key=f"dl_{basename}_{fmt}",
+                width="stretch",
+            )
+
+@st.fragment(run_every=1.0)
+def _job_progress(job_id: str, label: str) -> None:
+    job = get_job(job_id)
+    if job is None or job.done:
+        st.rerun()  # ページ全体を再実行して結果を描画
+    st.info(f"⏳ {label}（{job.elapsed:.0f} 秒経過）")
+    if job.cancel_requested.is_set():
+        st.caption("キャンセルしています…")
+    elif st.button("⏹ キャンセル", key=f"cancel_{job_id}"):
+        cancel_job(job_id)  # 実行中の HTTP 呼び出しも中断される
+        st.rerun()
+    if job.progress:
+        st.caption(job.progress)
+    if job.preview:
+        st.image(job.preview, caption="プレビュー（生成途中・低解像度）", width="stretch")
+
+def poll_job(state_key: str, *, label: str) -> Optional[Job]:
+    """session_state[state_key] のジョブを監視する。
+
+    完了していれば Job を返してキーを外す。実行中なら進捗を表示して None。
+    """
+    job_id = st.session_state.get(state_key)
+    if not job_id:
+        return None
+    job = get_job(job_id)
+    if job is None:
+        st.session_state.pop(state_key, None)
+        st.warning("実行中のジョブが見つかりません（サーバー再起動など）。もう一度実行してください。")
+        return None
+    if job.elapsed < 1.0:
+        job.wait(0.3)  # キャッシュ命中など即終わるジョブはフラグメントを挟まず表示
+    if job.done:
+        st.session_state.pop(state_key, None)
+        forget_job(job_id)
+        return job
+    _job_progress(job_id, label)
+    return None
+
+@st.fragment(run_every=1.0)
+def _batch_progress(job_ids: tuple, label: str, total: int) -> None:
+    jobs = [get_job(jid) for jid in job_ids]
+    if any(job is None or job.done for job in jobs):
+        st.rerun()  # 完了したものから順に描画する
+    st.info(f"⏳ {label}（完了 {total - len(jobs)}/{total}、{max(j.elapsed for j in jobs):.0f} 秒経過）")
+    if any(job.cancel_requested.is_set() for job in jobs):
+        st.caption("キャンセルしています…")
+    elif st.button("⏹ 残りをキャンセル", key=f"cancel_{job_ids[0]}"):
+        for job_id in job_ids:
+            cancel_job(job_id)
+        st.rerun()
+
+def poll_job_batch(state_key: str, *, label: str, total: int) -> List[Job]:
+    """session_state[state_key]（ジョブ ID のリスト）のうち、完了したジョブを返す。
+
+    未完了のものはキーに残し、どれかが終わった時点でページを再実行する。見失ったジョブ
+    （保持期限切れなど）は警告を出し、投入時の meta を持つ status="error"・error=JobLost の Job として返す。
+    """
+    job_ids = st.session_state.get(state_key) or []
+    metas: Dict[str, dict] = st.session_state.setdefault(f"{state_key}_meta", {})  # 見失ったときの手がかり
+    finished: List[Job] = []
+    pending: List[str] = []
+    for job_id in job_ids:
+        job = get_job(job_id)
+        if job is None:
+            st.warning("実行中のジョブが見つかりません（サーバー再起動など）。もう一度実行してください。")
+            finished.append(Job(id=job_id, kind="lost", meta=metas.pop(job_id, {}), status="error",
+                                error=JobLost("ジョブが見つかりません。もう一度実行してください。")))
+        elif job.done:
+            finished.append(job)
+            metas.pop(job_id, None)
+            forget_job(job_id)
+        else:
+            metas[job_id] = job.meta
+            pending.append(job_id)
+    if pending:
+        st.session_state[state_key] = pending
+        _batch_progress(tuple(pending), label, total)
+    else:
+        st.session_state.pop(state_key, None)
+        st.session_state.pop(f"{state_key}_meta", None)
+    return finished
+
+def cache_toggle() -> bool:
+    """結果キャッシュが有効な環境だけサイドバーにトグルを出す。"""
+    if not result_cache_enabled():
+        return False
+    return st.sidebar.toggle(
+        "⚡ 結果キャッシュを使う",
+        value=True,
+        help="同じモデル・プロンプト・サイズ（修正は元画像も同じ）の結果があれば API を呼ばずに表示します（課金なし）。",
+    )
+
+def output_format_picker() -> tuple[str, int]:
+    """サイドバーで出力形式と圧縮率を選ぶ。戻り値は (output_format, output_compression)。"""
+    cfg = get_section("image_output", OUTPUT_DEFAULTS)
+    fmt = cfg["output_format"] if cfg["output_format"] in IMAGE_FORMATS else "png"
+    if not cfg["user_selectable"]:
+        return fmt, cfg["output_compression"]
+    names = list(IMAGE_FORMATS)
+    fmt = st.sidebar.selectbox(
+        "出力形式", names, index=names.index(fmt),
+        help="webp / jpeg は PNG より大幅に小さく、表示・保存が速くなります（非可逆）。",
+    )
+    compression = cfg["output_compression"]
+    if fmt != "png":
+        compression = st.sidebar.slider("圧縮品質", 10, 100, compression, step=5,
+                                        help="大きいほど高画質・大きいファイル。")
+    return fmt, compression
+
+def result_badges(result) -> None:
+    """ImageResult（または同じキーを持つ dict）の由来（キャッシュ／相乗り）をバッジで表示。"""
+    flags = result if isinstance(result, dict) else vars(result)
+    if flags.get("cached"):
+        st.badge("キャッシュから表示（課金なし）", icon="⚡", color="green")
+    elif flags.get("coalesced"):
+        st.badge("同じリクエストの結果を共有（課金なし）", icon="🔗", color="blue")
+
+def history_controls(history: EditHistory, *, state_key: str = "simple_last_png") -> None:
+    """元に戻す／やり直す／版の一覧から分岐。移動したら session_state[state_key] を差し替えて再実行する。
+
+    どの操作も保存済みの版に切り替えるだけで、API は呼ばない。
+    """
+    steps = history.steps()
+    if not steps:
+        return
+    moved = None
+    col_undo, col_redo, col_info = st.columns([1, 1, 2])
+    with col_undo:
+        if st.button("↶ 元に戻す", key=f"{state_key}_undo", width="stretch", disabled=not history.can_undo()):
+            moved = history.undo()
+    with col_redo:
+        if st.button("↷ やり直す", key=f"{state_key}_redo", width="stretch", disabled=not history.can_redo()):
+            moved = history.redo()
+    with col_info:
+        cur = history.current
+        st.caption(f"現在: {cur.label() if cur else '—'}（履歴 {len(steps)} 件）")
+    with st.expander(f"編集履歴（{len(steps)} 件）"):
+        for row in range(0, len(steps), 4):
+            for col, step in zip(st.columns(4), steps[row:row + 4]):
+                with col:
+                    show_thumbnail(step.ref, caption=step.label())
+                    if step.parent is not None and history.get(step.parent) is not None:
+                        st.caption(f"← #{step.parent} から")
+                    if st.button("ここから続ける", key=f"{state_key}_checkout_{step.id}", width="stretch",
+                                 disabled=step.id == history.cursor):
+                        moved = history.checkout(step.id)
+    if moved is not None:
+        st.session_state[state_key] = moved.ref
+        st.rerun()
+
+def save_to_gallery(user: Optional[str], ref: BlobRef, **fields) -> None:
+    """ログイン中ならギャラリーに登録する（失敗しても画面の処理は続ける）。"""
+    gallery = get_gallery()
+    if not user or gallery is None:
+        return
+    try:
+        gallery.add(user, ref, **fields)
+    except (sqlite3.Error, OSError) as e:
+        st.warning(f"ギャラリーへの保存に失敗しました: {e}")
+
+def similar_images(user: Optional[str], image: BlobRef, *, state_key: str = "simple_last_png") -> None:
+    """ギャラリーにある似た画像（知覚ハッシュが近いもの）を出す。選べば作り直さずにそれを使える。"""
+    gallery = get_gallery()
+    if not user or gallery is None or not get_section("image_hash", IMAGE_HASH_DEFAULTS)["enabled"]:
+        return
+    try:
+        hits = gallery.similar(user, image)
+    except (sqlite3.Error, OSError) as e:
+        st.caption(f"似た画像の検索に失敗しました: {e}")
+        return
+    if not hits:
+        return
+    with st.expander(f"🔍 手持ちの似た画像（{len(hits)} 件）"):
+        st.caption("同じような画像がすでにあれば、作り直さずにそれを修正元にできます。")
+        for col, (dist, item) in zip(st.columns(len(hits)), hits):
+            with col:
+                st.image(item.thumb, caption=f"{item.action} / 距離 {dist}")
+                if st.button("これを使う", key=f"similar_{item.id}", width="stretch"):
+                    ref = put_blob(gallery.read(item.blob))
+                    st.session_state[state_key] = ref
+                    get_history().push(ref, action="gallery", size=item.size)
+                    st.rerun()
@@ -0,0 +1,74 @@
+# lib/url_fetch.py
+# 画像 URL の取得（接続プール共有・タイムアウト・サイズ上限つきのストリーミング読み込み）。
+# ジョブスレッドから呼ばれるので st.* は使わない。
+from __future__ import annotations
+import threading
+import time
+from typing import Optional
+
+import httpx
+
+from lib.jobs import current_job
+from lib.settings import get_section
+
+# secrets.toml の [url_fetch] で上書き可
+URL_FETCH_DEFAULTS = {
+    "max_bytes": 50_000_000,     # これを超える応答は途中で打ち切る
+    "connect_timeout": 10.0,
+    "read_timeout": 30.0,        # チャンク間の無通信の上限
+    "total_timeout": 60.0,       # 1 回の取得全体の上限
+    "max_connections": 10,
+    "max_keepalive_connections": 5,
+    "chunk_size": 256 * 1024,
+}
+
+class UrlFetchError(RuntimeError):
+    """画像 URL の取得に失敗した（サイズ超過・タイムアウト・HTTP エラー）。"""
+
+_client: Optional[httpx.Client] = None
+_client_lock = threading.Lock()
+
+def _get_client() -> httpx.Client:
+    global _client
+    with _client_lock:
+        if _client is None:
+            cfg = get_section("url_fetch", URL_FETCH_DEFAULTS)
+            _client = httpx.Client(
+                timeout=httpx.Timeout(cfg["read_timeout"], connect=cfg["connect_timeout"]),
+                limits=httpx.Limits(max_connections=cfg["max_connections"],
+                                    max_keepalive_connections=cfg["max_keepalive_connections"]),
+                follow_redirects=True,
+            )
+        return _client
+
+def fetch_bytes(url: str) -> bytes:
+    """url の中身を返す。http(s) 以外・max_bytes 超過・total_timeout 超過は UrlFetchError。
+
+    ジョブスレッドから呼ばれた場合はチャンクごとにキャンセルも確認する。
+    """
+    if not url.lower().startswith(("https://", "http://")):
+        raise UrlFetchError(f"http(s) 以外の URL は取得しません: {url[:40]}")
+    cfg = get_section("url_fetch", URL_FETCH_DEFAULTS)
+    max_bytes = cfg["max_bytes"]
+    deadline = time.monotonic() + cfg["total_timeout"]
+    job = current_job()
+    try:
+        with _get_client().stream("GET", url) as resp:
+            resp.raise_for_status()
+            declared = int(resp.headers.get("content-length") or 0)
+            if declared > max_bytes:
+                raise UrlFetchError(f"画像が大きすぎます（{declared:,} バイト）。")
+            chunks = []
+            received = 0
+            for chunk in resp.iter_bytes(cfg["chunk_size"]):
+                received += len(chunk)
+                if received > max_bytes:
+                    raise UrlFetchError(f"画像が大きすぎます（{max_bytes:,} バイト超）。")
+                if time.monotonic() > deadline:
+                    raise UrlFetchError(f"画像の取得が {cfg['total_timeout']:g} 秒以内に終わりませんでした。")
+                if job is not None:
+                    job.check_cancelled()
+                chunks.append(chunk)
+    except httpx.HTTPError as e:
+        raise UrlFetchError(f"画像の取得に失敗しました: {e}") from e
+    return chunks[0] if len(chunks) == 1 else b"".join(chunks)
@@ -17,7 +17,7 @@ from openai import OpenAI
 
 from lib.openai_client import get_client
 from lib.image_utils import pil_open, pil_to_png_bytes, as_named_file
-from lib.session_bridge import clear_edit_payload
+from lib.session_bridge import clear_edit_payload, get_edit_src_bytes
 from lib.ui import show_image, download_img_buttons
 
 # ───────────────────────────── ログ設定 ─────────────────────────────
@@ -89,6 +89,7 @@ def _apply_last_result_as_source():
         return
     # 直近の結果を「元画像」に昇格
     st.session_state["edit_src_bytes"] = b
+    st.session_state.pop("edit_src_blob", None)  # 01 から渡された画像より優先
     st.session_state["force_session_src"] = True
     # file_uploader の残留値で戻らないよう key 更新 & 直前キー破棄
     prev_rev = st.session_state.get("uploader_rev", 0)
@@ -122,7 +123,7 @@ if src_file is not None:
 
 # ────────────────────────── ユーティリティ ──────────────────────────
 def _get_session_image_if_any() -> Optional[Image.Image]:
-    b = st.session_state.get("edit_src_bytes")
+    b = get_edit_src_bytes()  # 01 から渡された画像（ブロブ）か、このページで置いた画像
     if not b:
         return None
     try:
@@ -133,6 +134,7 @@ def _get_session_image_if_any() -> Optional[Image.Image]:
 
 def _set_session_image(img: Image.Image, prompt_hint: str = "") -> None:
     st.session_state["edit_src_bytes"] = pil_to_png_bytes(img)
+    st.session_state.pop("edit_src_blob", None)
     if prompt_hint:
         st.session_state["edit_src_prompt"] = prompt_hint
     st.session_state["force_session_src"] = True
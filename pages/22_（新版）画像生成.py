@@ -20,19 +20,24 @@ for p in (MONO_ROOT, PROJ_DIR, APP_DIR):
 # ---------------------
 
 
-from io import BytesIO
-import base64, tempfile
 from typing import Dict, Any
 import streamlit as st
-from PIL import Image
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 from pathlib import Path
 import datetime as dt
 
 # ---- 共通ライブラリの読み込み ----
-from lib.openai_client import get_client
-from lib.image_utils import pil_to_png_bytes, url_to_png_bytes
+from lib.openai_client import get_async_client
+from lib.image_api import generate_png, edit_png
+from lib.blob_store import put_blob, read_blob
+from lib.edit_history import get_history
+from lib.jobs import submit_job
+from lib.prompt_search import request_prompt_sync
+from lib.retry import describe_error
+from lib.ui import (cache_toggle, other_format_downloads, output_format_picker, poll_job,
+                    poll_job_batch, history_controls, result_badges, save_to_gallery, show_preview,
+                    show_thumbnail, similar_images)
 
 # ログイン関連
 from common_lib.auth.auth_helpers import get_current_user_from_session_or_cookie
@@ -62,8 +67,10 @@ with col_user:
 # ============================================================
 # 環境初期化
 # ============================================================
-client: OpenAI = get_client()
-st.session_state.setdefault("simple_last_png", b"")
+client: AsyncOpenAI = get_async_client()  # キャンセルで通信ごと中断できる非同期版
+st.session_state.setdefault("simple_last_png", None)  # 現在の画像（BlobRef。中身は data/blobs/ のファイル）
+use_cache = cache_toggle()  # 結果キャッシュ（有効な環境のみ表示）
+output_format, output_compression = output_format_picker()  # png / webp / jpeg
 
 # アプリ／ページ情報
 APP_DIR = Path(__file__).resolve().parents[1]
@@ -78,49 +85,139 @@ JST = dt.timezone(dt.timedelta(hours=9), name="Asia/Tokyo")
 # ログにプロンプト全文を含めるか
 INCLUDE_FULL_PROMPT_IN_LOG = True
 
+MODEL = "gpt-image-1"
+PARTIAL_IMAGES = 2  # ストリーミング時に受け取る途中画像の枚数（0〜3）
+
 
 # ============================================================
-# 画像生成
+# 画像生成（ジョブに投入 → 完了をポーリング）
 # ============================================================
 prompt = st.text_area("生成プロンプト", height=100)
 size = st.selectbox("サイズ", ["1024x1024", "1024x1536", "1536x1024"], index=0)
+n_images = st.selectbox("枚数", [1, 2, 3, 4], index=0,
+                        help="2枚以上は1枚ずつ並列に生成し、できた順に表示します（1枚ごとに課金）。")
+stream_preview = st.toggle("生成途中のプレビューを表示する（ストリーミング・1枚のとき）", value=True)
+# 実行中は二重投入しない
+gen_pending = bool(st.session_state.get("gen_job_id") or st.session_state.get("gen_batch_ids"))
 
-if st.button("生成する", width="stretch"):
+if st.button("生成する", width="stretch", disabled=gen_pending) and not gen_pending:
     if not prompt.strip():
         st.warning("プロンプトを入力してください。")
         st.stop()
 
-    with st.spinner("画像を生成中…"):
-        res = client.images.generate(model="gpt-image-1", prompt=prompt.strip(), n=1, size=size)
-    d = res.data[0]
-
-    # バイナリ変換
-    if getattr(d, "b64_json", None):
-        img = Image.open(BytesIO(base64.b64decode(d.b64_json))).convert("RGBA")
-        png_bytes = pil_to_png_bytes(img)
-    elif getattr(d, "url", None):
-        png_bytes = url_to_png_bytes(d.url)
+    gen_args = dict(prompt=prompt.strip(), size=size, model=MODEL,
+                    user=user or "(anonymous)", use_cache=use_cache,
+                    output_format=output_format, output_compression=output_compression)
+    gen_meta = {"prompt": prompt.strip(), "size": size, "batch": n_images}
+    if n_images == 1:
+        st.session_state.pop("gen_grid", None)
+        st.session_state["gen_job_id"] = submit_job(
+            "generate", generate_png, client, **gen_args,
+            partial_images=PARTIAL_IMAGES if stream_preview else 0,
+            meta=gen_meta,
+        )
     else:
-        st.error("画像が返ってきませんでした。"); st.stop()
-
-    # 状態保存
-    st.session_state["simple_last_png"] = png_bytes
-
-    # ===== ログ記録（生成） =====
-    current_user = user or "(anonymous)"
+        # 1枚ずつの並列リクエストに分けて投入（variant で相乗り・キャッシュを区別）
+        st.session_state["gen_grid"] = [None] * n_images
+        st.session_state["gen_batch_ids"] = [
+            submit_job("generate", generate_png, client, **gen_args, variant=i,
+                       meta={**gen_meta, "variant": i})
+            for i in range(n_images)
+        ]
+
+
+def _log_generate(job, ref) -> None:
+    """生成1枚ぶんのログ（複数枚生成でも1枚ごとに記録＝課金単位）。blob はギャラリー／検索から画像を引くキー。"""
+    gen_prompt = job.meta["prompt"]
     logger.append({
-        "user": current_user,
+        "user": user or "(anonymous)",
         "action": "generate",
-        "model": "gpt-image-1",
-        "size": size,
+        "model": MODEL,
+        "size": job.meta["size"],
         "n": 1,
-        "prompt_hash": sha256_short(prompt.strip()),
-        **({"prompt": prompt.strip()} if INCLUDE_FULL_PROMPT_IN_LOG else {}),
+        **({"batch": job.meta["batch"], "variant": job.meta["variant"]} if job.meta["batch"] > 1 else {}),
+        "prompt_hash": sha256_short(gen_prompt),
+        **({"prompt": gen_prompt} if INCLUDE_FULL_PROMPT_IN_LOG else {}),
+        **job.result.log_fields(),
+        "blob": ref.key,
     })
+    request_prompt_sync()  # プロンプト検索の索引へ（背景で取り込む）
 
-    # 表示
-    st.subheader("生成された画像")
-    st.image(png_bytes, caption="生成結果", width="stretch")
+
+def _log_cancelled(job, target_action: str) -> None:
+    """キャンセルしたジョブは action を分けて記録（課金集計には含めない）。"""
+    logger.append({
+        "user": user or "(anonymous)",
+        "action": "cancelled",
+        "target_action": target_action,
+        "model": MODEL,
+        "size": job.meta["size"],
+        "elapsed_sec": round(job.elapsed, 1),
+        "prompt_hash": sha256_short(job.meta["prompt"]),
+        "billable": False,
+    })
+
+
+gen_job = poll_job("gen_job_id", label="画像を生成中…")
+if gen_job is not None:
+    if gen_job.cancelled:
+        st.warning("画像生成をキャンセルしました。")
+        _log_cancelled(gen_job, "generate")
+    elif gen_job.error is not None:
+        st.error(f"画像生成に失敗しました: {describe_error(gen_job.error)}")
+    else:
+        # 状態保存（セッションにはハンドルだけを持つ）
+        img_ref = put_blob(gen_job.result.data)
+        st.session_state["simple_last_png"] = img_ref
+        get_history().push(img_ref, action="generate", prompt=gen_job.meta["prompt"], size=gen_job.meta["size"])
+        save_to_gallery(user, img_ref, action="generate", model=MODEL, size=gen_job.meta["size"],
+                        prompt_hash=sha256_short(gen_job.meta["prompt"]))
+
+        # ===== ログ記録（生成） =====
+        _log_generate(gen_job, img_ref)
+
+        # 表示
+        st.subheader("生成された画像")
+        result_badges(gen_job.result)
+        show_preview(img_ref, caption="生成結果")
+
+# ----- 複数枚：できた順にグリッドへ -----
+grid = st.session_state.get("gen_grid")
+for job in poll_job_batch("gen_batch_ids", label="画像を生成中…", total=len(grid or [])):
+    if grid is None or "variant" not in job.meta:  # 見失ったジョブで投入時の情報も無いもの
+        continue
+    if job.cancelled:
+        grid[job.meta["variant"]] = "キャンセルしました。"
+        _log_cancelled(job, "generate")
+    elif job.error is not None:
+        grid[job.meta["variant"]] = describe_error(job.error)
+    else:
+        # 画像はブロブに置き、バッジ用の由来と履歴用のメタだけを残す
+        cell_ref = put_blob(job.result.data)
+        grid[job.meta["variant"]] = (cell_ref,
+                                     {"cached": job.result.cached, "coalesced": job.result.coalesced},
+                                     job.meta)
+        save_to_gallery(user, cell_ref, action="generate", model=MODEL, size=job.meta["size"],
+                        prompt_hash=sha256_short(job.meta["prompt"]))
+        _log_generate(job, cell_ref)
+
+if grid:
+    st.subheader("生成された画像（修正に使う1枚を選んでください）")
+    for i, (col, cell) in enumerate(zip(st.columns(len(grid)), grid)):
+        with col:
+            if cell is None:
+                st.info("生成中…")
+            elif isinstance(cell, str):
+                st.error(cell)
+            else:
+                cell_ref, cell_flags, cell_meta = cell
+                show_preview(cell_ref, caption=f"候補 {i + 1}")
+                result_badges(cell_flags)
+                if st.button("✏️ これを修正元にする", key=f"promote_{i}", width="stretch"):
+                    st.session_state["simple_last_png"] = cell_ref
+                    get_history().push(cell_ref, action="generate", prompt=cell_meta["prompt"],
+                                       size=cell_meta["size"])
+                    st.rerun()
 
 
 # ============================================================
@@ -132,55 +229,65 @@ if not st.session_state.get("simple_last_png"):
     st.stop()
 
 st.subheader("現在の処理対象画像（修正元になる画像）")
-st.image(st.session_state["simple_last_png"], caption="現在の元画像", width="stretch")
+show_preview(st.session_state["simple_last_png"], caption="現在の元画像")
+history_controls(get_history())  # 元に戻す／やり直す／分岐（API は呼ばない）
+similar_images(user, st.session_state["simple_last_png"])  # ギャラリーの似た画像
 
 edit_prompt = st.text_area("修正内容を入力", value="背景を夕焼けに、全体をシネマティックに", height=100)
 edit_size = st.selectbox("修正後のサイズ", ["1024x1024", "1024x1536", "1536x1024"], index=0)
+edit_pending = bool(st.session_state.get("edit_job_id"))
 
-if st.button("修正版を生成する（修正内容のプロンプトを反映します．修正のプロンプトを入力してからクリックしてください．）", width="stretch"):
+if st.button("修正版を生成する（修正内容のプロンプトを反映します．修正のプロンプトを入力してからクリックしてください．）",
+             width="stretch", disabled=edit_pending) and not edit_pending:
     if not edit_prompt.strip():
         st.warning("修正内容を入力してください。")
         st.stop()
 
-    with st.spinner("修正版を生成中..."):
-        with tempfile.NamedTemporaryFile(suffix=".png") as tmp:
-            tmp.write(st.session_state["simple_last_png"])
-            tmp.seek(0)
-            res2 = client.images.edit(
-                model="gpt-image-1",
-                image=("image.png", tmp),
-                prompt=edit_prompt.strip(),
-                size=edit_size,
-            )
-
-        datum = res2.data[0]
-        if getattr(datum, "b64_json", None):
-            img2 = Image.open(BytesIO(base64.b64decode(datum.b64_json))).convert("RGBA")
-            out_bytes = pil_to_png_bytes(img2)
-        elif getattr(datum, "url", None):
-            out_bytes = url_to_png_bytes(datum.url)
-        else:
-            st.error("修正結果がありません。"); st.stop()
+    st.session_state["edit_job_id"] = submit_job(
+        "edit", edit_png, client,
+        src_png=read_blob(st.session_state["simple_last_png"]),
+        prompt=edit_prompt.strip(), size=edit_size, model=MODEL, user=user or "(anonymous)",
+        use_cache=use_cache, output_format=output_format, output_compression=output_compression,
+        meta={"prompt": edit_prompt.strip(), "size": edit_size, "parent": get_history().cursor},
+    )
 
+edit_job = poll_job("edit_job_id", label="修正版を生成中…")
+if edit_job is not None:
+    if edit_job.cancelled:
+        st.warning("修正版の生成をキャンセルしました。")
+        _log_cancelled(edit_job, "edit")
+    elif edit_job.error is not None:
+        st.error(f"修正版の生成に失敗しました: {describe_error(edit_job.error)}")
+    else:
         # 🔁 修正版を再び元画像に昇格（連続修正OK）
-        st.session_state["simple_last_png"] = out_bytes
+        out_ref = put_blob(edit_job.result.data)
+        st.session_state["simple_last_png"] = out_ref
+        get_history().push(out_ref, action="edit", prompt=edit_job.meta["prompt"], size=edit_job.meta["size"],
+                           parent=edit_job.meta["parent"])
+        save_to_gallery(user, out_ref, action="edit", model=MODEL, size=edit_job.meta["size"],
+                        prompt_hash=sha256_short(edit_job.meta["prompt"]))
 
         # ===== ログ記録（修正） =====
         current_user = user or "(anonymous)"
+        edit_prompt_used = edit_job.meta["prompt"]
         logger.append({
             "user": current_user,
             "action": "edit",
             "source": "inline",
-            "model": "gpt-image-1",
-            "size": edit_size,
-            "prompt_hash": sha256_short(edit_prompt.strip()),
-            **({"prompt": edit_prompt.strip()} if INCLUDE_FULL_PROMPT_IN_LOG else {}),
+            "model": MODEL,
+            "size": edit_job.meta["size"],
+            "prompt_hash": sha256_short(edit_prompt_used),
+            **({"prompt": edit_prompt_used} if INCLUDE_FULL_PROMPT_IN_LOG else {}),
+            **edit_job.result.log_fields(),
+            "blob": out_ref.key,
         })
+        request_prompt_sync()
 
         st.success("修正版を生成しました。さらに修正を続けられます。")
 
         st.subheader("プロンプトによって修正された画像（今回の修正元画像）")
-        st.image(out_bytes, caption="修正版（次の元画像）", width="stretch")
+        result_badges(edit_job.result)
+        show_preview(out_ref, caption="修正版（次の元画像）")
 
 
 # ============================================================
@@ -189,26 +296,27 @@ if st.button("修正版を生成する（修正内容のプロンプトを反映
 st.divider()
 st.subheader("💾 生成画像の保存")
 
-png_bytes = st.session_state.get("simple_last_png", b"")
+img_ref = st.session_state.get("simple_last_png")
 
-if png_bytes:
+if img_ref:
     # サムネイル表示
     try:
-        thumb = Image.open(BytesIO(png_bytes)).copy()
-        thumb.thumbnail((256, 256))
-        st.image(thumb, caption="現在の画像（サムネイル表示）")
+        show_thumbnail(img_ref, caption="現在の画像（サムネイル表示）")  # 派生画像キャッシュから（再計算しない）
     except Exception as e:
         st.warning(f"サムネイル生成に失敗しました: {e}")
 
     # ダウンロードボタン（ファイル名もJST基準）
-    default_name = f"generated_{dt.datetime.now(JST):%Y%m%d_%H%M%S}.png"
+    ext = img_ref.ext  # API から受け取った形式のまま保存する
+    default_name = f"generated_{dt.datetime.now(JST):%Y%m%d_%H%M%S}.{ext}"
     dl_name = st.text_input("ファイル名（ダウンロード用）", value=default_name)
     st.download_button(
-        "⬇️ 保存（.png）",
-        data=png_bytes,
+        f"⬇️ 保存（.{ext}）",
+        data=img_ref.read,  # 押されたときだけ読んで渡す（再実行のたびにメディア領域へ送らない）
         file_name=dl_name,
-        mime="image/png",
+        mime=img_ref.mime,
         width="stretch",
     )
+    with st.expander("別の形式で保存"):
+        other_format_downloads(img_ref, Path(dl_name).stem, src_fmt=img_ref.fmt)
 else:
     st.info("まだ保存できる画像がありません。上で生成または修正を行ってください。")
@@ -7,15 +7,21 @@
 # ============================================================
 
 from __future__ import annotations
-from io import BytesIO
-import base64, tempfile
 from typing import Dict, Any
 import streamlit as st
-from PIL import Image
-from openai import OpenAI
-
-from lib.openai_client import get_client
-from lib.image_utils import pil_to_png_bytes, url_to_png_bytes
+from openai import AsyncOpenAI
+
+from lib.openai_client import get_async_client
+from lib.image_api import edit_png
+from lib.blob_store import put_blob, read_blob
+from lib.edit_history import get_history
+from lib.image_utils import normalize_upload
+from lib.jobs import submit_job
+from lib.prompt_search import request_prompt_sync
+from lib.retry import describe_error
+from lib.ui import (cache_toggle, other_format_downloads, output_format_picker, poll_job,
+                    history_controls, result_badges, save_to_gallery, show_preview, show_thumbnail,
+                    similar_images)
 
 from pathlib import Path
 import datetime as dt
@@ -45,12 +51,15 @@ PAGE_NAME = Path(__file__).stem
 logger = JsonlLogger(app_dir=APP_DIR, page_name=PAGE_NAME)
 
 INCLUDE_FULL_PROMPT_IN_LOG = True
+MODEL = "gpt-image-1"
 JST = dt.timezone(dt.timedelta(hours=9), name="Asia/Tokyo")
 
 # --------------------- クライアント & セッション ---------------------
-client: OpenAI = get_client()
-st.session_state.setdefault("simple_last_png", b"")  # 現在の修正対象PNG（常に最新）
-st.session_state.setdefault("uploaded_png", b"")     # アップロード直後のPNG（初期元画像）
+client: AsyncOpenAI = get_async_client()  # キャンセルで通信ごと中断できる非同期版
+st.session_state.setdefault("simple_last_png", None)  # 現在の修正対象（BlobRef。常に最新・API が返した形式のまま）
+st.session_state.setdefault("uploaded_png", None)     # アップロード直後のPNG（BlobRef。初期元画像）
+use_cache = cache_toggle()  # 結果キャッシュ（有効な環境のみ表示）
+output_format, output_compression = output_format_picker()  # png / webp / jpeg
 
 # ============================================================
 # 1) 画像アップロード
@@ -69,8 +78,9 @@ with col_up2:
     use_uploaded_clicked = st.button("⬆️ アップロード画像を読み込む", width="stretch")
 
 if reset_clicked:
-    st.session_state["uploaded_png"] = b""
-    st.session_state["simple_last_png"] = b""
+    st.session_state["uploaded_png"] = None
+    st.session_state["simple_last_png"] = None
+    get_history().clear()
     st.success("状態をリセットしました。")
     # ログ：リセット
     logger.append({
@@ -84,10 +94,12 @@ if use_uploaded_clicked:
         st.warning("先に画像ファイルを選択してください。")
     else:
         try:
-            img = Image.open(uploaded).convert("RGBA")
-            png_bytes = pil_to_png_bytes(img)
-            st.session_state["uploaded_png"] = png_bytes
-            st.session_state["simple_last_png"] = png_bytes  # 初期の修正対象に昇格
+            # 長辺 1536px 以下に縮小しながら読み込む（EXIF の向きを反映、透過が無ければ RGB）
+            png_bytes = normalize_upload(uploaded)
+            up_ref = put_blob(png_bytes)
+            st.session_state["uploaded_png"] = up_ref
+            st.session_state["simple_last_png"] = up_ref  # 初期の修正対象に昇格
+            get_history().push(up_ref, action="upload")
             st.success("アップロード画像を読み込みました。")
             # ログ：アップロード読み込み
             logger.append({
@@ -100,10 +112,12 @@ if use_uploaded_clicked:
             st.error(f"画像の読み込みに失敗しました: {e}")
 
 # 現在の元画像（修正対象）を表示
-current_png = st.session_state.get("simple_last_png", b"")
+current_png = st.session_state.get("simple_last_png")
 if current_png:
     st.subheader("現在の処理対象画像（修正元）")
-    st.image(current_png, caption="現在の元画像", width="stretch")
+    show_preview(current_png, caption="現在の元画像")
+    history_controls(get_history())  # 元に戻す／やり直す／分岐（API は呼ばない）
+    similar_images(user, current_png)  # ギャラリーの似た画像
 else:
     st.info("画像が未設定です。上で画像をアップロードして読み込んでください。")
     st.stop()
@@ -125,8 +139,9 @@ edit_size = st.selectbox(
     ["1024x1024", "1024x1536", "1536x1024"],
     index=0
 )
+edit_pending = bool(st.session_state.get("edit_job_id"))  # 実行中は二重投入しない
 
-if st.button("🪄 修正版を生成する", width="stretch"):
+if st.button("🪄 修正版を生成する", width="stretch", disabled=edit_pending) and not edit_pending:
     if not edit_prompt.strip():
         st.warning("修正内容を入力してください。")
         st.stop()
@@ -134,44 +149,60 @@ if st.button("🪄 修正版を生成する", width="stretch"):
         st.warning("修正する元画像がありません。アップロード→読み込みを行ってください。")
         st.stop()
 
-    with st.spinner("修正版を生成中..."):
-        # 一時ファイルにPNGを書き出して images.edit へ
-        with tempfile.NamedTemporaryFile(suffix=".png") as tmp:
-            tmp.write(st.session_state["simple_last_png"])
-            tmp.seek(0)
-            res2 = client.images.edit(
-                model="gpt-image-1",
-                image=("image.png", tmp),
-                prompt=edit_prompt.strip(),
-                size=edit_size,
-            )
-
-        datum = res2.data[0]
-        if getattr(datum, "b64_json", None):
-            img2 = Image.open(BytesIO(base64.b64decode(datum.b64_json))).convert("RGBA")
-            out_bytes = pil_to_png_bytes(img2)
-        elif getattr(datum, "url", None):
-            out_bytes = url_to_png_bytes(datum.url)
-        else:
-            st.error("修正結果が取得できませんでした。"); st.stop()
+    # images.edit はジョブスレッドで実行（スクリプトスレッドを塞がない）
+    st.session_state["edit_job_id"] = submit_job(
+        "edit", edit_png, client,
+        src_png=read_blob(st.session_state["simple_last_png"]),
+        prompt=edit_prompt.strip(), size=edit_size, model=MODEL, user=user or "(anonymous)",
+        use_cache=use_cache, output_format=output_format, output_compression=output_compression,
+        meta={"prompt": edit_prompt.strip(), "size": edit_size, "parent": get_history().cursor},
+    )
 
+edit_job = poll_job("edit_job_id", label="修正版を生成中…")
+if edit_job is not None:
+    if edit_job.cancelled:
+        st.warning("修正版の生成をキャンセルしました。")
+        # キャンセルは action を分けて記録（課金集計には含めない）
+        logger.append({
+            "user": user or "(anonymous)",
+            "action": "cancelled",
+            "target_action": "edit",
+            "model": MODEL,
+            "size": edit_job.meta["size"],
+            "elapsed_sec": round(edit_job.elapsed, 1),
+            "prompt_hash": sha256_short(edit_job.meta["prompt"]),
+            "billable": False,
+        })
+    elif edit_job.error is not None:
+        st.error(f"修正版の生成に失敗しました: {describe_error(edit_job.error)}")
+    else:
         # 🔁 修正版を再び元画像に昇格（連続修正OK）
-        st.session_state["simple_last_png"] = out_bytes
+        out_ref = put_blob(edit_job.result.data)
+        st.session_state["simple_last_png"] = out_ref
+        get_history().push(out_ref, action="edit", prompt=edit_job.meta["prompt"], size=edit_job.meta["size"],
+                           parent=edit_job.meta["parent"])
+        save_to_gallery(user, out_ref, action="edit", model=MODEL, size=edit_job.meta["size"],
+                        prompt_hash=sha256_short(edit_job.meta["prompt"]))
 
         # ログ：編集
+        edit_prompt_used = edit_job.meta["prompt"]
         logger.append({
             "user": user or "(anonymous)",
             "action": "edit",
             "source": "inline",
-            "model": "gpt-image-1",
-            "size": edit_size,
-            "prompt_hash": sha256_short(edit_prompt.strip()),
-            **({"prompt": edit_prompt.strip()} if INCLUDE_FULL_PROMPT_IN_LOG else {}),
+            "model": MODEL,
+            "size": edit_job.meta["size"],
+            "prompt_hash": sha256_short(edit_prompt_used),
+            **({"prompt": edit_prompt_used} if INCLUDE_FULL_PROMPT_IN_LOG else {}),
+            **edit_job.result.log_fields(),
+            "blob": out_ref.key,  # ギャラリー／検索から画像を引くキー
         })
+        request_prompt_sync()  # プロンプト検索の索引へ（背景で取り込む）
 
         st.success("修正版を生成しました。さらに修正を続けられます。")
         st.subheader("今回の修正結果")
-        st.image(out_bytes, caption="修正版（次の元画像になります）", width="stretch")
+        result_badges(edit_job.result)
+        show_preview(out_ref, caption="修正版（次の元画像になります）")
 
 # ============================================================
 # 3) 保存セクション（ページ下部）
@@ -179,24 +210,25 @@ if st.button("🪄 修正版を生成する", width="stretch"):
 st.divider()
 st.subheader("3) 生成画像の保存")
 
-png_bytes = st.session_state.get("simple_last_png", b"")
-if png_bytes:
+img_ref = st.session_state.get("simple_last_png")
+if img_ref:
     # サムネイル表示（小さめ）
     try:
-        thumb = Image.open(BytesIO(png_bytes)).copy()
-        thumb.thumbnail((256, 256))  # サムネイル最大サイズ
-        st.image(thumb, caption="現在の画像（サムネイル）")
+        show_thumbnail(img_ref, caption="現在の画像（サムネイル）")  # 派生画像キャッシュから（再計算しない）
     except Exception as e:
         st.warning(f"サムネイル生成に失敗しました: {e}")
 
-    default_name = f"edited_{dt.datetime.now(JST):%Y%m%d_%H%M%S}.png"  # ダウンロード名もJST基準
+    ext = img_ref.ext  # API から受け取った形式のまま保存する
+    default_name = f"edited_{dt.datetime.now(JST):%Y%m%d_%H%M%S}.{ext}"  # ダウンロード名もJST基準
     dl_name = st.text_input("ファイル名（ダウンロード用）", value=default_name)
     st.download_button(
-        "⬇️ ブラウザに保存（.png）",
-        data=png_bytes,
+        f"⬇️ ブラウザに保存（.{ext}）",
+        data=img_ref.read,  # 押されたときだけ読んで渡す（再実行のたびにメディア領域へ送らない）
         file_name=dl_name,
-        mime="image/png",
+        mime=img_ref.mime,
         width="stretch",
     )
+    with st.expander("別の形式で保存"):
+        other_format_downloads(img_ref, Path(dl_name).stem, src_fmt=img_ref.fmt)
 else:
     st.info("保存できる画像がありません。上で修正を実行してください。")
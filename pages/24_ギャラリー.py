@@ -0,0 +1,100 @@
+# pages/24_ギャラリー.py
+# ============================================================
+# 🖼️ マイギャラリー（自分が生成・修正した画像の一覧）
+# + ログイン中のユーザーの画像だけを新しい順に表示
+# + 一覧はサムネイルのみ（原寸はダウンロード／修正元にするときだけ読む）
+# ============================================================
+
+from __future__ import annotations
+import datetime as dt
+
+import streamlit as st
+
+from lib.blob_store import put_blob
+from lib.edit_history import get_history
+from lib.gallery import GALLERY_DEFAULTS, get_gallery
+from lib.image_utils import IMAGE_FORMATS
+from lib.settings import get_section
+
+# ★ ログイン関連（共通ヘルパー）
+from common_lib.auth.auth_helpers import get_current_user_from_session_or_cookie
+
+# --------------------- ページ設定 ---------------------
+st.set_page_config(page_title="マイギャラリー", page_icon="🖼️", layout="wide")
+
+left, right = st.columns([5, 2], vertical_alignment="center")
+with left:
+    st.title("🖼️ マイギャラリー")
+with right:
+    user, _payload = get_current_user_from_session_or_cookie(st)
+    if user:
+        st.success(f"ログイン中: **{user}**")
+    else:
+        st.warning("未ログイン（Cookie 未検出）")
+
+if not user:
+    st.info("ギャラリーはログイン中のユーザーごとに保存されます。サインインしてください。")
+    st.stop()
+
+gallery = get_gallery()
+if gallery is None:
+    st.info("この環境ではギャラリーが無効です（secrets.toml の [gallery] enabled）。")
+    st.stop()
+
+cfg = get_section("gallery", GALLERY_DEFAULTS)
+JST = dt.timezone(dt.timedelta(hours=9), name="Asia/Tokyo")
+EDIT_PAGE = "pages/23_（新版）画像修正.py"
+
+# ページ位置は「各ページ先頭の 1 つ前の行 (ts, id)」の積み重ねで持つ（キーセット方式）
+st.session_state.setdefault("gallery_cursors", [])
+cursors: list = st.session_state["gallery_cursors"]
+before = cursors[-1] if cursors else None
+
+items = gallery.page(user, before=before, limit=cfg["page_size"] + 1)
+has_next = len(items) > cfg["page_size"]
+items = items[:cfg["page_size"]]
+
+st.caption(f"全 {gallery.count(user):,} 枚 / {len(cursors) + 1} ページ目")
+if not items:
+    st.info("まだ画像がありません。生成・修正した画像はここに保存されます。")
+    st.stop()
+
+# ============================================================
+# サムネイル一覧
+# ============================================================
+for row in range(0, len(items), cfg["columns"]):
+    for col, item in zip(st.columns(cfg["columns"]), items[row:row + cfg["columns"]]):
+        with col:
+            taken = dt.datetime.fromtimestamp(item.ts, JST)
+            st.image(item.thumb, caption=f"{taken:%Y-%m-%d %H:%M} {item.action} {item.width}x{item.height}")
+            mime, ext = IMAGE_FORMATS.get(item.fmt, IMAGE_FORMATS["png"])
+            st.download_button(
+                f"⬇️ 保存（.{ext}）",
+                data=lambda key=item.blob: gallery.read(key),  # 押されたときだけ原寸を読む
+                file_name=f"{item.action}_{taken:%Y%m%d_%H%M%S}.{ext}",
+                mime=mime,
+                key=f"gallery_dl_{item.id}",
+                width="stretch",
+            )
+            if st.button("✏️ 修正元にする", key=f"gallery_edit_{item.id}", width="stretch"):
+                ref = put_blob(gallery.read(item.blob))
+                st.session_state["simple_last_png"] = ref
+                get_history().push(ref, action="gallery", size=item.size)
+                st.switch_page(EDIT_PAGE)
+
+# ============================================================
+# ページ送り
+# ============================================================
+col_first, col_prev, col_next = st.columns(3)
+with col_first:
+    if st.button("⏮ 最新へ", width="stretch", disabled=not cursors):
+        cursors.clear()
+        st.rerun()
+with col_prev:
+    if st.button("◀ 新しいページ", width="stretch", disabled=not cursors):
+        cursors.pop()
+        st.rerun()
+with col_next:
+    if st.button("古いページ ▶", width="stretch", disabled=not has_next):
+        cursors.append(items[-1].cursor)
+        st.rerun()
@@ -0,0 +1,109 @@
+# pages/25_プロンプト検索.py
+# ============================================================
+# 🔎 プロンプト検索（過去の生成／修正で使ったプロンプトを全文検索）
+# + ログ（logs/{app_name}.log.jsonl）を SQLite FTS5 に追記分だけ取り込んで検索（取り込みは生成・修正時に背景で）
+# + 自分のプロンプトのみ（管理者は全ユーザーも可）
+# + ギャラリーに残っている画像はサムネイルとダウンロードを表示
+# ============================================================
+
+from __future__ import annotations
+import streamlit as st
+
+from lib.gallery import get_gallery
+from lib.image_utils import IMAGE_FORMATS
+from lib.prompt_search import PROMPT_SEARCH_DEFAULTS, get_prompt_index
+from lib.settings import get_section
+
+# ★ ログイン関連（共通ヘルパー）
+from common_lib.auth.auth_helpers import get_current_user_from_session_or_cookie, is_admin
+
+# --------------------- ページ設定 ---------------------
+st.set_page_config(page_title="プロンプト検索", page_icon="🔎", layout="wide")
+
+left, right = st.columns([5, 2], vertical_alignment="center")
+with left:
+    st.title("🔎 プロンプト検索")
+with right:
+    user, _payload = get_current_user_from_session_or_cookie(st)
+    if user:
+        st.success(f"ログイン中: **{user}**")
+    else:
+        st.warning("未ログイン（Cookie 未検出）")
+
+if not user:
+    st.info("自分が使ったプロンプトを検索できます。サインインしてください。")
+    st.stop()
+
+index = get_prompt_index()
+if index is None:
+    st.info("この環境ではプロンプト検索が無効です（secrets.toml の [prompt_search] enabled）。")
+    st.stop()
+
+cfg = get_section("prompt_search", PROMPT_SEARCH_DEFAULTS)
+gallery = get_gallery()
+
+# 生成・修正ページが書くたびに背景で取り込んでいるので、ここで残るのはその後の追記分だけ
+# （索引を作り直したときや、検索が有効になる前のログがあるときはログ全体を読むので時間がかかる）
+with st.spinner("ログを取り込み中…"):
+    index.sync()
+
+col_q, col_scope = st.columns([4, 1], vertical_alignment="bottom")
+with col_q:
+    query = st.text_input("検索語（空白区切りですべてを含むものを検索）", placeholder="例）夕焼け シネマティック")
+with col_scope:
+    all_users = is_admin(user) and st.checkbox("全ユーザー", help="管理者のみ")
+
+if not query.strip():
+    st.caption(f"索引済みのプロンプト: {index.count():,} 件")
+    st.stop()
+
+# ページ位置は「各ページ最後の rowid」の積み重ね（キーセット方式）。検索語が変わったら先頭へ
+if st.session_state.get("prompt_search_query") != (query, all_users):
+    st.session_state["prompt_search_query"] = (query, all_users)
+    st.session_state["prompt_search_cursors"] = []
+cursors: list = st.session_state["prompt_search_cursors"]
+
+hits = index.search(query, user=None if all_users else user, limit=cfg["page_size"] + 1,
+                    before=cursors[-1] if cursors else None)
+has_next = len(hits) > cfg["page_size"]
+hits = hits[:cfg["page_size"]]
+
+if not hits:
+    st.info("一致するプロンプトはありません。")
+    st.stop()
+
+# ============================================================
+# 検索結果
+# ============================================================
+for hit in hits:
+    col_img, col_text = st.columns([1, 5])
+    item = gallery.find(hit.blob) if gallery is not None and hit.blob else None
+    with col_img:
+        if item is not None:
+            st.image(item.thumb)
+        else:
+            st.caption("（画像なし）")
+    with col_text:
+        st.markdown(hit.snippet)  # プロンプト中の Markdown 記号はエスケープ済み
+        who = f" / {hit.user}" if all_users else ""
+        st.caption(f"{hit.ts[:16].replace('T', ' ')} / {hit.action} / {hit.size}{who}")
+        if item is not None:
+            mime, ext = IMAGE_FORMATS.get(item.fmt, IMAGE_FORMATS["png"])
+            st.download_button(
+                f"⬇️ 画像を保存（.{ext}）",
+                data=lambda key=item.blob: gallery.read(key),  # 押されたときだけ原寸を読む
+                file_name=f"{hit.action}_{hit.rowid}.{ext}",
+                mime=mime,
+                key=f"prompt_dl_{hit.rowid}",
+            )
+    st.divider()
+
+col_first, col_next = st.columns(2)
+with col_first:
+    if st.button("⏮ 最新へ", width="stretch", disabled=not cursors):
+        cursors.clear()
+        st.rerun()
+with col_next:
+    if st.button("さらに古い結果 ▶", width="stretch", disabled=not has_next):
+        cursors.append(hits[-1].rowid)
+        st.rerun()
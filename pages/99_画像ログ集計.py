@@ -30,6 +30,7 @@ def _add_commonlib_parent_to_syspath():
 _add_commonlib_parent_to_syspath()
 # --- then your original imports ---
 from common_lib.auth.auth_helpers import get_current_user_from_session_or_cookie, is_admin
+from lib.memory_budget import get_memory_budget
 
 
 
@@ -107,6 +108,11 @@ def load_logs(path: Path) -> pd.DataFrame:
         df["month"] = None
 
     df["user"] = df.get("user", "(anonymous)").fillna("(anonymous)")
+
+    # 課金対象：generate / edit のうち billable=False（相乗りなど API 未呼び出し）を除く
+    # billable 列が無い古いログは全件課金対象として扱う
+    billable = df["billable"].fillna(True).astype(bool) if "billable" in df.columns else True
+    df["billable"] = df.get("action", pd.Series(index=df.index, dtype=object)).isin(["generate", "edit"]) & billable
     return df
 
 
@@ -126,6 +132,22 @@ with st.expander("📁 ログファイル情報", expanded=False):
         st.warning("ログファイルが存在しません。")
         st.stop()
 
+# ============================================================
+# 画像キャッシュのメモリ（このサーバープロセス）
+# ============================================================
+with st.expander("🧠 画像キャッシュのメモリ使用量", expanded=False):
+    mem = get_memory_budget().stats()
+    c1, c2 = st.columns(2)
+    c1.metric("使用中", f"{mem['bytes'] / 1e6:,.1f} MB", help=f"{mem['entries']:,} 件")
+    c2.metric("上限", f"{mem['max_bytes'] / 1e6:,.0f} MB", help="secrets.toml の [memory_budget] max_bytes")
+    if mem["owners"]:
+        st.dataframe(pd.DataFrame([
+            {"キャッシュ": name, "MB": round(o["bytes"] / 1e6, 1), "件数": o["entries"],
+             "退避": o["spills"], "退避/分": round(o["spills_per_min"], 2),
+             "読み戻し": o["reloads"], "読み戻し/分": round(o["reloads_per_min"], 2)}
+            for name, o in mem["owners"].items()
+        ]), hide_index=True)
+
 if df.empty:
     st.warning("ログデータがありません。")
     st.stop()
@@ -158,14 +180,19 @@ st.caption(f"対象レコード: **{len(fdf):,} / {len(df):,}**")
 # ============================================================
 # サマリメトリクス
 # ============================================================
-gen_cnt = (fdf["action"] == "generate").sum()
-edit_cnt = (fdf["action"] == "edit").sum()
+gen_cnt = ((fdf["action"] == "generate") & fdf["billable"]).sum()
+edit_cnt = ((fdf["action"] == "edit") & fdf["billable"]).sum()
+free_cnt = (fdf["action"].isin(["generate", "edit"]) & ~fdf["billable"]).sum()
+cancel_cnt = (fdf["action"] == "cancelled").sum()
 unique_users = fdf["user"].nunique()
 
-m1, m2, m3 = st.columns(3)
+m1, m2, m3, m4, m5 = st.columns(5)
 m1.metric("作成（generate）", f"{gen_cnt:,}")
 m2.metric("改修（edit）", f"{edit_cnt:,}")
-m3.metric("ユニークユーザー", f"{unique_users:,}")
+m3.metric("課金なし（相乗り等）", f"{free_cnt:,}")
+m4.metric("キャンセル", f"{cancel_cnt:,}")
+m5.metric("ユニークユーザー", f"{unique_users:,}")
+st.caption("作成・改修の件数と以下の集計は課金対象（billable）のみ。同一リクエストへの相乗りは実際に API を呼んだユーザーに計上します。")
 
 
 # ============================================================
@@ -175,7 +202,7 @@ st.divider()
 st.subheader("👤 ユーザー別 集計")
 
 user_pivot = (
-    fdf[fdf["action"].isin(["generate", "edit"])]
+    fdf[fdf["billable"]]
     .pivot_table(index="user", columns="action", values="ts", aggfunc="count", fill_value=0)
     .reset_index()
 )
@@ -202,7 +229,7 @@ st.divider()
 st.subheader("🗓️ 月別 集計")
 
 monthly = (
-    fdf[fdf["action"].isin(["generate", "edit"])]
+    fdf[fdf["billable"]]
     .groupby(["month", "action"])["ts"]
     .count()
     .unstack(fill_value=0)
@@ -234,8 +261,8 @@ st.download_button(
 st.divider()
 st.subheader("👥🗓️ ユーザー × 月別 集計")
 
-# 対象データ（generate / edit のみ）
-df_um = fdf[fdf["action"].isin(["generate", "edit"])].copy()
+# 対象データ（generate / edit のうち課金対象のみ）
+df_um = fdf[fdf["billable"]].copy()
 if df_um.empty:
     st.info("対象期間・ユーザーに該当するログがありません。")
 else: